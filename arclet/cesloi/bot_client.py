@@ -3,20 +3,25 @@ import sys
 import time
 import traceback
 from asyncio import Task
-from typing import Optional, Union, List, Type
+from base64 import b64decode
+from typing import Optional, Union, List, Type, Iterable, Dict, Tuple
 
 from arclet.cesloi.utils import enter_message_send_context, UploadMethods, bot_application_context_manager, \
-    upload_method
+    upload_method, DecodeOptions, HttpPoolConfig, decode_model
 from arclet.letoderea import EventSystem, Condition_T, TemplateDecorator, TemplateEvent
+from arclet.letoderea.entities.subscriber import Subscriber
 from arclet.cesloi.event.lifecycle import ApplicationRunning, ApplicationStop
 from arclet.cesloi.event.messages import Message, GroupMessage, FriendMessage, TempMessage
 from arclet.cesloi.logger import Logger
-from arclet.cesloi.communicate_with_mah import BotSession, Communicator
-from arclet.cesloi.model.utils import BotMessage, Profile, FileInfo
+from arclet.cesloi.communicate_with_mah import BotSession, Communicator, UploadFile, UploadSource
+from arclet.cesloi.model.utils import BotMessage, Profile, FileInfo, BroadcastResult
 from arclet.cesloi.message.element import Source, MessageElement
 from arclet.cesloi.model.relation import Group, Member, GroupConfig, MemberInfo, Friend
+from arclet.cesloi.model.cache import RelationshipCache, IdentityMap
 from arclet.cesloi.message.messageChain import MessageChain
 from arclet.cesloi.plugin import Bellidin
+from arclet.cesloi.send_scheduler import SendScheduler
+from arclet.cesloi.executor import ExecutionMode, ExecutorManager, get_executor, set_executor
 
 
 class Cesloi:
@@ -29,14 +34,47 @@ class Cesloi:
             debug: bool = False,
             enable_chat_log: bool = True,
             use_loguru_traceback: Optional[bool] = True,
+            ingest_workers: int = 4,
+            ingest_queue_size: int = 1024,
+            ingest_overflow: str = "block",
+            api_transport: str = "http",
+            api_timeout: float = 30.0,
+            trusted_upstream: bool = False,
+            http_pool: Optional[HttpPoolConfig] = None,
+            send_scheduler: Optional[SendScheduler] = None,
+            relationship_ttl: float = 600.0,
+            identity_map_size: int = 0,  # 大于 0 时启用 IdentityMap, 事件中的实体对象会被共享并原地更新
+            executor: Optional[ExecutorManager] = None,
     ):
         self.event_system: EventSystem = event_system or EventSystem()
         self.bot_session: BotSession = bot_session
         self.debug = debug
         self.logger = logger or Logger(level='DEBUG' if debug else 'INFO').logger
         self.bellidin = Bellidin.set_bellidin(self.event_system, self.logger)
+        self.executor = executor  # 由本实例持有, 关闭时一并关闭; 不填时使用全局共用的执行器, 关闭时不受影响
+        self._previous_executor: Optional[ExecutorManager] = None
+        if executor:
+            self._previous_executor = get_executor()
+            set_executor(executor)
         self.chat_log_enabled = enable_chat_log
-        self.communicator = Communicator(bot_session, bot=self, event_system=self.event_system, logger=self.logger)
+        self.communicator = Communicator(
+            bot_session,
+            bot=self,
+            event_system=self.event_system,
+            logger=self.logger,
+            ingest_workers=ingest_workers,
+            ingest_queue_size=ingest_queue_size,
+            ingest_overflow=ingest_overflow,
+            api_transport=api_transport,
+            api_timeout=api_timeout,
+            http_pool=http_pool,
+            decode_options=DecodeOptions(
+                trusted_upstream=trusted_upstream and not debug,  # 调试模式下始终进行完整校验
+                identity_map=IdentityMap(identity_map_size) if identity_map_size > 0 else None,
+            ),
+        )
+        self.send_scheduler = send_scheduler
+        self.relationship = RelationshipCache(relationship_ttl)
         self.running: bool = False
         self.daemon_task: Optional[Task] = None
         self.group_message_log_format: str = "{bot_id}: [{group_name}({group_id})] {member_name}({member_id}) -> {" \
@@ -132,7 +170,14 @@ class Cesloi:
         if self.daemon_task:
             self.daemon_task.cancel()
             self.daemon_task = None
+        if self.send_scheduler:
+            await self.send_scheduler.close()
         await self.communicator.stop()
+        await self.communicator.close_session()
+        if self.executor:
+            if get_executor() is self.executor:
+                set_executor(self._previous_executor)
+            self.executor.shutdown(wait=False)
         for t in asyncio.all_tasks(self.event_system.loop):
             if (
                     t is not asyncio.current_task(self.event_system.loop)
@@ -145,6 +190,10 @@ class Cesloi:
                 except asyncio.CancelledError:
                     pass
 
+    def get_http_session(self):
+        """应用的所有出站 HTTP 请求共用的连接池"""
+        return self.communicator.get_session()
+
     def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
         if self.event_system:
             loop = self.event_system.loop
@@ -174,18 +223,32 @@ class Cesloi:
             *,
             priority: int = 16,
             conditions: List[Condition_T] = None,
-            decorators: List[TemplateDecorator] = None
+            decorators: List[TemplateDecorator] = None,
+            mode: ExecutionMode = ExecutionMode.auto
     ):
         """
         注册事件方法，用于指定订阅器订阅的发布器绑定的事件。
+
+        mode 为函数的执行方式, 默认时同步函数放入线程池执行, 参考executor.ExecutionMode
         """
-        return self.event_system.register(event, priority=priority, conditions=conditions, decorators=decorators)
+        register_wrapper = self.event_system.register(
+            event, priority=priority, conditions=conditions, decorators=decorators
+        )
 
-    def install_plugins(self, plugins_dir: str):
+        def wrapper(exec_target):
+            if not isinstance(exec_target, Subscriber):
+                exec_target = get_executor().wrap(exec_target, mode)
+            return register_wrapper(exec_target)
+
+        return wrapper
+
+    def install_plugins(self, plugins_dir: str, lazy: bool = False, manifest: Optional[str] = None):
         """
         导入插件方法，必须传入一个目录，目录内有你的.py文件或模块
+
+        lazy 为 True 时插件只在其订阅的事件首次到达时才被导入, 参考Bellidin.install_plugins
         """
-        return self.bellidin.install_plugins(plugins_dir)
+        return self.bellidin.install_plugins(plugins_dir, lazy=lazy, manifest=manifest)
 
     def uninstall_plugins(self):
         """
@@ -211,30 +274,46 @@ class Cesloi:
         )
         return MessageChain.parse_obj(result['messageChain'])
 
-    async def get_friend_list(self):
+    async def get_friend_list(self, refresh: bool = False) -> List[Friend]:
+        """获取好友列表; 缓存未过期时不会请求上游, refresh 为 True 时强制刷新"""
+        if not refresh and self.relationship.fresh("friends"):
+            return list(self.relationship.friends.values())
         result = await self.communicator.send_handle(
             "friendList",
             "GET",
             {"sessionKey": self.bot_session.sessionKey}
         )
-        return [Friend.parse_obj(i) for i in result]
-
-    async def get_group_list(self):
+        friends = [decode_model(Friend, i, self.communicator.decode_options) for i in result]
+        self.relationship.set_friends(friends)
+        return friends
+
+    async def get_group_list(self, refresh: bool = False) -> List[Group]:
+        """获取群列表; 缓存未过期时不会请求上游, refresh 为 True 时强制刷新"""
+        if not refresh and self.relationship.fresh("groups"):
+            return list(self.relationship.groups.values())
         result = await self.communicator.send_handle(
             "groupList",
             "GET",
             {"sessionKey": self.bot_session.sessionKey}
         )
-        return [Group.parse_obj(i) for i in result]
-
-    async def get_member_list(self, group: Union[Group, int]):
+        groups = [decode_model(Group, i, self.communicator.decode_options) for i in result]
+        self.relationship.set_groups(groups)
+        return groups
+
+    async def get_member_list(self, group: Union[Group, int], refresh: bool = False) -> List[Member]:
+        """获取群成员列表; 缓存未过期时不会请求上游, refresh 为 True 时强制刷新"""
+        group_id = group if isinstance(group, int) else group.id
+        if not refresh and self.relationship.fresh(("members", group_id)):
+            return list(self.relationship.members[group_id].values())
         result = await self.communicator.send_handle(
             "memberList",
             "GET",
             {"sessionKey": self.bot_session.sessionKey,
-             "target": group if isinstance(group, int) else group.id}
+             "target": group_id}
         )
-        return [Member.parse_obj(i) for i in result]
+        members = [decode_model(Member, i, self.communicator.decode_options) for i in result]
+        self.relationship.set_members(group_id, members)
+        return members
 
     async def find(
             self,
@@ -249,23 +328,17 @@ class Cesloi:
             target_id : 已知的好友id或者群成员id
             group : 尝试获取的已知的群组
         """
+        if isinstance(group, Group):
+            group = group.id
         if target_id and not group:
-            data_friend = await self.get_friend_list()
-            for i in data_friend:
-                if i.id == target_id:
-                    return i
+            await self.get_friend_list()
+            return self.relationship.friends.get(target_id)
         if group and not target_id:
-            if isinstance(group, Group):
-                group = group.id
-            data_group = await self.get_group_list()
-            for i in data_group:
-                if i.id == group:
-                    return i
+            await self.get_group_list()
+            return self.relationship.groups.get(group)
         if group and target_id:
-            data_member = await self.get_member_list(group)
-            for i in data_member:
-                if i.id == target_id:
-                    return i
+            await self.get_member_list(group)
+            return self.relationship.members[group].get(target_id)
 
     async def get_bot_profile(self):
         result = await self.communicator.send_handle(
@@ -327,6 +400,7 @@ class Cesloi:
             message: Union[MessageChain, str],
             *,
             quote: Optional[Union[Source, int]] = None,
+            priority: int = 16,
     ) -> BotMessage:
         """使用此方法向指定好友发送消息, 可以指定需要回复的消息.
 
@@ -334,14 +408,29 @@ class Cesloi:
             target : 指定的好友
             message : 消息链
             quote : 需要回复的消息源, 默认为 None.
+            priority : 启用发送调度器时的优先级, 数值越小越先发送
 
         Returns:
             BotMessage:含有一 `messageId` 属性, 可用于回复.
         """
         if isinstance(message, str):
             message = MessageChain.create(message)
+        target_id = target.id if isinstance(target, Friend) else target
+        if self.send_scheduler:
+            return await self.send_scheduler.submit(
+                ("friend", target_id),
+                message,
+                lambda chain: self._send_friend_message(target_id, chain, quote),
+                priority=priority,
+                coalesce=not quote
+            )
+        return await self._send_friend_message(target_id, message, quote)
+
+    @bot_application_context_manager
+    async def _send_friend_message(
+            self, target_id: int, message: MessageChain, quote: Optional[Union[Source, int]]
+    ) -> BotMessage:
         with enter_message_send_context(UploadMethods.Friend):
-            target_id = target.id if isinstance(target, Friend) else target
             result = await self.communicator.send_handle(
                 "sendFriendMessage",
                 "POST",
@@ -364,6 +453,7 @@ class Cesloi:
             message: Union[MessageChain, str],
             *,
             quote: Optional[Union[Source, int]] = None,
+            priority: int = 16,
     ) -> BotMessage:
         """使用此方法向指定群组发送消息, 可以指定需要回复的消息.
 
@@ -371,14 +461,29 @@ class Cesloi:
             target : 指定的群组.
             message : 消息链
             quote : 需要回复的消息源, 默认为 None.
+            priority : 启用发送调度器时的优先级, 数值越小越先发送
 
         Returns:
             BotMessage:含有一 `messageId` 属性, 可用于回复.
         """
         if isinstance(message, str):
             message = MessageChain.create(message)
+        target_id = target.id if isinstance(target, Group) else target
+        if self.send_scheduler:
+            return await self.send_scheduler.submit(
+                ("group", target_id),
+                message,
+                lambda chain: self._send_group_message(target_id, chain, quote),
+                priority=priority,
+                coalesce=not quote
+            )
+        return await self._send_group_message(target_id, message, quote)
+
+    @bot_application_context_manager
+    async def _send_group_message(
+            self, target_id: int, message: MessageChain, quote: Optional[Union[Source, int]]
+    ) -> BotMessage:
         with enter_message_send_context(UploadMethods.Group):
-            target_id = target.id if isinstance(target, Group) else target
             result = await self.communicator.send_handle(
                 "sendGroupMessage",
                 "POST",
@@ -402,6 +507,7 @@ class Cesloi:
             group: Optional[Union[Group, int]] = None,
             *,
             quote: Optional[Union[Source, int]] = None,
+            priority: int = 16,
     ) -> BotMessage:
         """使用此方法向指定群组中的特定组员发送消息, 可指定需要回复的消息.
 
@@ -410,6 +516,7 @@ class Cesloi:
             group : 指定的群组.
             message : 消息链.
             quote : 需要回复的消息源, 默认为 None.
+            priority : 启用发送调度器时的优先级, 数值越小越先发送
 
         Returns:
             BotMessage:含有一 `messageId` 属性, 可用于回复.
@@ -419,9 +526,23 @@ class Cesloi:
         group = target.group if (isinstance(target, Member) and not group) else group
         if not group:
             raise ValueError("Missing argument: group")
+        group_id = group.id if isinstance(group, Group) else group
+        target_id = target.id if isinstance(target, Member) else target
+        if self.send_scheduler:
+            return await self.send_scheduler.submit(
+                ("temp", group_id, target_id),
+                message,
+                lambda chain: self._send_temp_message(target_id, group_id, chain, quote),
+                priority=priority,
+                coalesce=not quote
+            )
+        return await self._send_temp_message(target_id, group_id, message, quote)
+
+    @bot_application_context_manager
+    async def _send_temp_message(
+            self, target_id: int, group_id: int, message: MessageChain, quote: Optional[Union[Source, int]]
+    ) -> BotMessage:
         with enter_message_send_context(UploadMethods.Temp):
-            group_id = group.id if isinstance(group, Group) else group
-            target_id = target.id if isinstance(target, Member) else target
             result = await self.communicator.send_handle(
                 "sendTempMessage",
                 "POST",
@@ -481,6 +602,105 @@ class Cesloi:
                     f"target {target} unclear! Please take an instance of the dialog object type as a parameter"
                 )
 
+    async def broadcast(
+            self,
+            targets: Iterable[Union[Group, Friend, Member, int]],
+            message: Union[MessageChain, str],
+            *,
+            concurrency: int = 10,
+            priority: int = 16,
+    ) -> BroadcastResult:
+        """向多个对象发送同一条消息; 消息链中待上传的图片与语音按对象的类型 (群、好友、临时会话) 各上传一次,
+        每种类型的消息链只序列化一次; 语音只能发送到群, 发给其他对象时记为失败
+
+        Args:
+            targets: 发送对象, 整数视为群号
+            message: 消息链
+            concurrency: 同时进行的发送数量上限
+            priority: 启用发送调度器时的优先级
+
+        Returns:
+            BroadcastResult: 各对象的发送结果与失败原因
+        """
+        if isinstance(message, str):
+            message = MessageChain.create(message)
+        sends: Dict[Tuple[Union[str, int], ...], Tuple[str, dict]] = {}
+        for target in targets:
+            if isinstance(target, Member):
+                sends[("temp", target.group.id, target.id)] = (
+                    "sendTempMessage", {"group": target.group.id, "qq": target.id}
+                )
+            elif isinstance(target, Friend):
+                sends[("friend", target.id)] = ("sendFriendMessage", {"target": target.id})
+            else:
+                target_id = target.id if isinstance(target, Group) else target
+                sends[("group", target_id)] = ("sendGroupMessage", {"target": target_id})
+        result = BroadcastResult()
+        if not sends:
+            return result
+        serialized: Dict[str, List[dict]] = {}  # 各类型的对象使用的消息链
+        unchanged: Optional[List[dict]] = None  # 没有需要上传的元素时, 各类型共用同一份
+        for kind in dict.fromkeys(key[0] for key in sends):
+            try:
+                chain = await self._upload_media(message, kind)
+            except Exception as e:
+                result.failed.update((key, e) for key in sends if key[0] == kind)
+                continue
+            if chain is not message:
+                serialized[kind] = chain.dict()["__root__"]
+            else:
+                unchanged = unchanged or message.dict()["__root__"]
+                serialized[kind] = unchanged
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(key: Tuple[Union[str, int], ...], action: str, body: dict):
+            chain = serialized[key[0]]
+            async with semaphore:
+                try:
+                    if self.send_scheduler:
+                        bot_message = await self.send_scheduler.submit(
+                            key, message, lambda _: self._send_serialized(action, body, chain),
+                            priority=priority, coalesce=False
+                        )
+                    else:
+                        bot_message = await self._send_serialized(action, body, chain)
+                except Exception as e:
+                    result.failed[key] = e
+                else:
+                    result.succeeded[key] = bot_message
+
+        await asyncio.gather(*(send(key, *value) for key, value in sends.items() if key[0] in serialized))
+        self.logger.info(
+            f"[BOT {self.bot_session.account}] Broadcast({len(result.succeeded)}/{len(sends)}) <- {message.to_text()}"
+        )
+        return result
+
+    async def _upload_media(self, message: MessageChain, method: str) -> MessageChain:
+        """将消息链中以 base64 携带的图片与语音按 method 上传, 替换为只含 id 的元素; 没有需要上传的元素时返回原消息链"""
+        from .message.element import Image, FlashImage, Voice
+        elements = []
+        uploaded = False
+        for element in message:
+            if isinstance(element, Image) and element.base64 and not element.imageId:
+                element = await self.upload_image(
+                    b64decode(element.base64), method, is_flash=isinstance(element, FlashImage)
+                )
+                uploaded = True
+            elif isinstance(element, Voice) and element.base64 and not element.voiceId:
+                element = await self.upload_voice(b64decode(element.base64), method)
+                uploaded = True
+            elements.append(element)
+        return MessageChain.create(elements) if uploaded else message
+
+    @bot_application_context_manager
+    async def _send_serialized(self, action: str, target: dict, serialized: List[dict]) -> BotMessage:
+        result = await self.communicator.send_handle(
+            action,
+            "POST",
+            {"sessionKey": self.bot_session.sessionKey, **target, "messageChain": serialized}
+        )
+        return BotMessage.parse_obj({"messageId": result['messageId']})
+
     async def send_nudge(self, target: Union[Friend, Member, int]):
         target_id = target if isinstance(target, int) else target.id
         await self.communicator.send_handle(
@@ -743,42 +963,59 @@ class Cesloi:
             }
         )
 
-    async def upload_image(self, data: bytes, may_method: Optional[str] = None, is_flash: bool = False):
+    async def upload_image(self, data: UploadSource, may_method: Optional[str] = None, is_flash: bool = False):
+        """上传图片, 得到可以重复发送的图片元素
+
+        Args:
+            data: 图片的路径、二进制文件对象、产出 bytes 的异步迭代器或 bytes, 以流的形式上传
+            may_method: 上传类型, 默认取自当前的发送上下文
+            is_flash: 是否返回闪照元素
+        """
         from .message.element import Image
         from .message.element import FlashImage
         method = may_method or upload_method.get().value
         result = await self.communicator.send_handle(
-            "uploadIamge",
-            "MULIPART",
+            "uploadImage",
+            "MULTIPART",
             {
                 "sessionKey": self.bot_session.sessionKey,
                 "type": method,
-                "img": data
+                "img": UploadFile(data)
             }
         )
         if is_flash:
             return FlashImage.parse_obj(result)
         return Image.parse_obj(result)
 
-    async def upload_voice(self, data: bytes, may_method: Optional[str] = None):
+    async def upload_voice(self, data: UploadSource, may_method: Optional[str] = None):
+        """上传语音, 参数同 upload_image"""
         from .message.element import Voice
         method = may_method or upload_method.get().value
         if method == "group":
             result = await self.communicator.send_handle(
                 "uploadVoice",
-                "MULIPART",
+                "MULTIPART",
                 {
                     "sessionKey": self.bot_session.sessionKey,
                     "type": method,
-                    "img": data
+                    "voice": UploadFile(data)
                 }
             )
             return Voice.parse_obj(result)
         else:
             raise TypeError("Voice is only provides sending in group!")
 
-    async def upload_file(self, data: bytes, target: Union[Group, int], may_method: Optional[str] = None,
-                          path: str = "", ):
+    async def upload_file(self, data: UploadSource, target: Union[Group, int], may_method: Optional[str] = None,
+                          path: str = "", name: Optional[str] = None):
+        """上传群文件
+
+        Args:
+            data: 文件的路径、二进制文件对象、产出 bytes 的异步迭代器或 bytes, 以流的形式上传
+            target: 目标群
+            may_method: 上传类型, 默认取自当前的发送上下文
+            path: 上传目录的id, 空串为根目录
+            name: 上传后的文件名, 默认取自文件路径或文件对象
+        """
         method = may_method or upload_method.get().value
         if method == "group":
             result = await self.communicator.send_handle(
@@ -786,10 +1023,10 @@ class Cesloi:
                 "MULTIPART",
                 {
                     "sessionKey": self.bot_session.sessionKey,
-                    "type": method.value,
+                    "type": method,
                     "target": target if isinstance(target, int) else target.id,
                     "path": path,
-                    "file": data,
+                    "file": UploadFile(data, name),
                 },
             )
             return FileInfo.parse_obj(result)
@@ -0,0 +1,171 @@
+"""
+Cesloi 在数据传输路径上使用的 JSON 编解码器
+
+安装了 orjson 或 ujson 时会自动选用, 否则回退到标准库 json; 也可以通过 set_codec 手动指定
+"""
+import json
+from enum import Enum
+from typing import Any, Union, Dict, Type
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _default(obj: Any):
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    """标准库 json 实现的编解码器, 也是其他编解码器的基类"""
+    name: str = "json"
+
+    @staticmethod
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default)
+
+    @classmethod
+    def dumps_bytes(cls, obj: Any) -> bytes:
+        return cls.dumps(obj).encode("utf-8")
+
+
+class OrjsonCodec(JsonCodec):
+    name: str = "orjson"
+
+    @staticmethod
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj, default=_default).decode("utf-8")
+
+    @classmethod
+    def dumps_bytes(cls, obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+
+class UjsonCodec(JsonCodec):
+    name: str = "ujson"
+
+    @staticmethod
+    def loads(data: Union[str, bytes]) -> Any:
+        return ujson.loads(data)
+
+    @staticmethod
+    def dumps(obj: Any) -> str:
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, default=_default)
+
+
+codecs: Dict[str, Type[JsonCodec]] = {
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+    "json": JsonCodec,
+}
+
+
+def _available(name: str) -> bool:
+    return {"orjson": orjson, "ujson": ujson}.get(name, json) is not None
+
+
+def _auto_codec() -> Type[JsonCodec]:
+    for name, codec in codecs.items():
+        if _available(name):
+            return codec
+    return JsonCodec
+
+
+_codec: Type[JsonCodec] = _auto_codec()
+
+
+def set_codec(codec: Union[str, Type[JsonCodec]]) -> Type[JsonCodec]:
+    """指定全局使用的编解码器
+
+    Args:
+        codec: 编解码器的名称 ("orjson", "ujson", "json") 或 JsonCodec 的子类
+    """
+    global _codec
+    if isinstance(codec, str):
+        if codec not in codecs:
+            raise ValueError(f"Unknown codec: {codec}")
+        if not _available(codec):
+            raise ImportError(f"{codec} is not installed")
+        codec = codecs[codec]
+    _codec = codec
+    return codec
+
+
+def get_codec() -> Type[JsonCodec]:
+    return _codec
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    return _codec.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    return _codec.dumps(obj)
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    return _codec.dumps_bytes(obj)
+
+
+if __name__ == "__main__":
+    """
+    各编解码器在 mirai-api-http 数据上的基准测试
+    """
+    import timeit
+
+    group_message_frame = json.dumps({"syncId": "-1", "data": {
+        "type": "GroupMessage", "messageChain": [
+            {"type": "Source", "id": 123456, "time": 1638000000},
+            {"type": "At", "target": 1234567890, "display": "@Cesloi"},
+            {"type": "Plain", "text": " 今天天气怎么样"},
+            {"type": "Image", "imageId": "{01E9451B-70ED-EAE3-B37C-101F1EEBF5B5}.jpg",
+             "url": "https://gchat.qpic.cn/gchatpic_new/0/0-0-01E9451B70EDEAE3B37C101F1EEBF5B5/0"}
+        ], "sender": {
+            "id": 3165388245, "memberName": "RF-Tar-Railt", "specialTitle": "", "permission": "OWNER",
+            "joinTimestamp": 1600000000, "lastSpeakTimestamp": 1638000000, "muteTimeRemaining": 0,
+            "group": {"id": 123456789, "name": "Cesloi测试群", "permission": "ADMINISTRATOR"}
+        }
+    }}, ensure_ascii=False)
+    member_list_response = json.dumps({"code": 0, "msg": "", "data": [
+        {"id": 10000 + i, "memberName": f"群员{i}", "specialTitle": "", "permission": "MEMBER",
+         "joinTimestamp": 1600000000, "lastSpeakTimestamp": 1638000000, "muteTimeRemaining": 0,
+         "group": {"id": 123456789, "name": "Cesloi测试群", "permission": "ADMINISTRATOR"}}
+        for i in range(500)
+    ]}, ensure_ascii=False)
+    send_message_body = {
+        "sessionKey": "YourSessionKey", "target": 123456789,
+        "messageChain": [
+            {"type": "At", "target": 3165388245},
+            {"type": "Plain", "text": " 晴, 最高气温 25℃"},
+            {"type": "Image", "imageId": "{01E9451B-70ED-EAE3-B37C-101F1EEBF5B5}.jpg"}
+        ]
+    }
+
+    for name, codec in codecs.items():
+        if not _available(name):
+            print(f"{name}: not installed")
+            continue
+        frame = timeit.timeit(lambda: codec.loads(group_message_frame), number=20000)
+        member = timeit.timeit(lambda: codec.loads(member_list_response), number=200)
+        body = timeit.timeit(lambda: codec.dumps_bytes(send_message_body), number=20000)
+        print(
+            f"{name:>6}: "
+            f"loads(frame) {frame / 20000 * 1e6:.2f}us, "
+            f"loads(memberList) {member / 200 * 1e6:.2f}us, "
+            f"dumps(sendGroupMessage) {body / 20000 * 1e6:.2f}us"
+        )
@@ -1,19 +1,23 @@
 import asyncio
 import inspect
-import json
-import random
+import itertools
+import os
+import time
 from asyncio import Task
 
 import aiohttp
-from typing import Optional, Union, Dict, TYPE_CHECKING, Awaitable, Callable
+from pathlib import Path
+from typing import Optional, Union, Dict, TYPE_CHECKING, Awaitable, Callable, List, Tuple, Any, AsyncIterable, \
+    BinaryIO
 from aiohttp import ClientSession, WSMsgType
 from yarl import URL
 
-from arclet.cesloi.utils import enter_context, Structured
+from arclet.cesloi.utils import enter_context, Structured, DecodeOptions, HttpPoolConfig, decode_model
 from arclet.letoderea import EventSystem, search_event
 from arclet.cesloi.logger import Logger
+from . import codec
 from .utils import error_check
-from .event.base import MiraiEvent
+from .event.base import MiraiEvent, event_type_map
 
 if TYPE_CHECKING:
     from .bot_client import Cesloi
@@ -48,6 +52,114 @@ class BotSession(Structured):
         )
 
 
+UploadSource = Union[str, os.PathLike, BinaryIO, AsyncIterable[bytes], bytes]
+
+
+class UploadFile:
+    """
+    在 multipart 请求中以流的形式上传的文件, 上传时按块读取, 不会将整个文件读入内存
+
+    Args:
+        source: 文件路径、二进制文件对象、产出 bytes 的异步迭代器或 bytes
+        filename: 上传时使用的文件名, 默认取自文件路径或文件对象
+    """
+    source: UploadSource
+    filename: str
+
+    def __init__(self, source: UploadSource, filename: Optional[str] = None):
+        if isinstance(source, str):
+            source = Path(source)
+        if filename is None:
+            name = source if isinstance(source, os.PathLike) else getattr(source, "name", None)
+            filename = os.path.basename(name) if isinstance(name, (str, os.PathLike)) else "file"
+        self.source = source
+        self.filename = filename
+        self._opened: Optional[BinaryIO] = None
+
+    def open(self) -> Union[BinaryIO, AsyncIterable[bytes], bytes]:
+        """返回交给 aiohttp 的请求体; 路径会在此时打开, 请求结束后由 close 关闭"""
+        if isinstance(self.source, os.PathLike):
+            if not os.path.isfile(self.source):
+                raise FileNotFoundError(f"{self.source} is not exist!")
+            self._opened = open(self.source, "rb")
+            return self._opened
+        return self.source
+
+    def close(self):
+        if self._opened:
+            self._opened.close()
+            self._opened = None
+
+
+class IngestQueue:
+    """
+    位于 websocket 读取循环与解析/分发 worker 之间的有界队列
+
+    Args:
+        maxsize: 队列容量, 小于等于0时不设上限
+        overflow: 队列满时的策略
+         - "block": 读取循环等待队列腾出空间 (背压)
+         - "drop_new": 丢弃新到达的数据帧
+         - "drop_oldest": 丢弃队列中最早的数据帧
+    """
+    overflow_policies = ("block", "drop_new", "drop_oldest")
+
+    def __init__(self, maxsize: int = 0, overflow: str = "block"):
+        if overflow not in self.overflow_policies:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.queue: "asyncio.Queue[Tuple[float, Any]]" = asyncio.Queue(max(maxsize, 0))
+        self.overflow = overflow
+        self.received: int = 0
+        self.processed: int = 0
+        self.dropped: int = 0
+        self.last_lag: float = 0.0
+        self.max_lag: float = 0.0
+        self.total_lag: float = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def put(self, item: Any) -> bool:
+        """放入一个数据帧, 返回该数据帧是否被接收"""
+        self.received += 1
+        if self.queue.full():
+            if self.overflow == "drop_new":
+                self.dropped += 1
+                return False
+            if self.overflow == "drop_oldest":
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+        await self.queue.put((time.monotonic(), item))
+        return True
+
+    async def get(self) -> Any:
+        enqueue_time, item = await self.queue.get()
+        lag = time.monotonic() - enqueue_time
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+        self.processed += 1
+        return item
+
+    def task_done(self):
+        self.queue.task_done()
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        """返回队列深度与排队延迟(单位为秒)等统计信息"""
+        return {
+            "depth": self.depth,
+            "maxsize": self.queue.maxsize,
+            "received": self.received,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "avg_lag": self.total_lag / self.processed if self.processed else 0.0,
+        }
+
+
 class Communicator:
     bot_session: BotSession
     event_system: EventSystem
@@ -59,8 +171,34 @@ class Communicator:
             bot_session: BotSession,
             bot: "Cesloi",
             event_system: EventSystem,
-            logger: Optional[Logger] = None
+            logger: Optional[Logger] = None,
+            *,
+            ingest_workers: int = 4,
+            ingest_queue_size: int = 1024,
+            ingest_overflow: str = "block",
+            api_transport: str = "http",
+            api_timeout: float = 30.0,
+            http_pool: Optional[HttpPoolConfig] = None,
+            decode_options: Optional[DecodeOptions] = None,
     ):
+        """
+        Args:
+            bot_session: 会话实体
+            bot: 应用实例
+            event_system: 事件系统
+            logger: 日志器
+            ingest_workers: 解析/分发数据帧的 worker 数量
+            ingest_queue_size: 接收队列的容量, 小于等于0时不设上限
+            ingest_overflow: 接收队列满时的策略, 参考 IngestQueue
+            api_transport: API 的调用方式, "http" 或 "websocket"; 后者复用 `/all` 连接并以 syncId 区分响应
+            api_timeout: 单次 API 调用的默认超时时间, 单位为秒
+            http_pool: 连接池配置, 连接池在重连时保留, 由 close_session 关闭
+            decode_options: 入站数据的解析选项, 不填时进行完整校验
+        """
+        if ingest_workers < 1:
+            raise ValueError("ingest_workers must be at least 1")
+        if api_transport not in ("http", "websocket"):
+            raise ValueError(f"Unknown api transport: {api_transport}")
         self.bot_session = bot_session
         self.event_system = event_system
         self.loop = event_system.loop
@@ -72,6 +210,44 @@ class Communicator:
         self.client_session: Optional[ClientSession] = None
         self.wait_response_future: Dict[str, asyncio.Future] = {}
         self.timeout: float = 60.0
+        self.ingest_workers = ingest_workers
+        self.ingest_queue = IngestQueue(ingest_queue_size, ingest_overflow)
+        self.worker_tasks: List[Task] = []
+        self.api_transport = api_transport
+        self.api_timeout = api_timeout
+        self.http_pool = http_pool or HttpPoolConfig()
+        self.decode_options = decode_options or DecodeOptions()
+        self.sync_id_counter = itertools.count(1)
+
+    def ingest_metrics(self) -> Dict[str, Union[int, float]]:
+        """接收队列的深度、延迟与丢弃数量等统计信息"""
+        return {"workers": len(self.worker_tasks), **self.ingest_queue.metrics()}
+
+    async def ingest_worker(self):
+        while True:
+            raw_data = await self.ingest_queue.get()
+            try:
+                await self.ws_receive_handle(codec.loads(raw_data))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.exception(f"receive_data has error {e}")
+            finally:
+                self.ingest_queue.task_done()
+
+    def start_workers(self):
+        self.worker_tasks = [
+            t for t in self.worker_tasks if not t.done()
+        ]
+        while len(self.worker_tasks) < self.ingest_workers:
+            self.worker_tasks.append(self.loop.create_task(self.ingest_worker()))
+
+    async def stop_workers(self):
+        for task in self.worker_tasks:
+            task.cancel()
+        if self.worker_tasks:
+            await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
 
     async def stop(self):
         self.running = False
@@ -81,8 +257,23 @@ class Communicator:
             except asyncio.CancelledError:
                 pass
         self.running_task = None
+        await self.stop_workers()
+        for future in self.wait_response_future.values():
+            if not future.done():
+                future.set_exception(ConnectionError("websocket connection closed"))
+        self.wait_response_future.clear()
         self.bot_session.sessionKey = None
-        await self.client_session.close()
+
+    def get_session(self) -> ClientSession:
+        """返回共享的连接池, 尚未创建或已被关闭时按配置重新创建"""
+        if not self.client_session or self.client_session.closed:
+            self.client_session = self.http_pool.create_session()
+        return self.client_session
+
+    async def close_session(self):
+        if self.client_session and not self.client_session.closed:
+            await self.client_session.close()
+        self.client_session = None
 
     @staticmethod
     async def run_always_await(any_callable: Union[Awaitable, Callable]):
@@ -104,6 +295,9 @@ class Communicator:
         event_type: Optional[str] = data.get("type")
         if not event_type or not isinstance(event_type, str):
             raise TypeError("Unable to find 'type' field for automatic parsing")
+        event_class = event_type_map.get(event_type)
+        if event_class:  # type 字段与事件类的默认值一致, 无需复制一份去掉 type 的 dict
+            return decode_model(event_class, data, self.decode_options)
         event_class: Optional[MiraiEvent] = search_event(event_type)
         if not event_class:
             self.logger.error(
@@ -111,59 +305,106 @@ class Communicator:
             )
             raise ValueError(f"Unable to find event: {event_type}", data)
         data = {k: v for k, v in data.items() if k != "type"}
-        return event_class.parse_obj(data)
+        return decode_model(event_class, data, self.decode_options)
 
     async def ws_send_handle(
             self,
-            command_name: str, data: Optional[dict] = None, subcommand: Optional[str] = None):
+            command_name: str,
+            data: Optional[dict] = None,
+            subcommand: Optional[str] = None,
+            *,
+            timeout: Optional[float] = None
+    ):
+        """通过 `/all` websocket 调用一个 API, 并等待对应 syncId 的响应
+
+        Args:
+            command_name: 命令名, 例如 sendGroupMessage
+            data: 命令的参数
+            subcommand: 子命令, 例如 get/update
+            timeout: 等待响应的超时时间, 默认为 `api_timeout`
+        """
         if not self.bot_session.verifyKey:
             raise ValueError
-        sync_id = str(random.randint(0, 100_000_000))
+        if not self.ws_connection or self.ws_connection.closed:
+            raise ConnectionError("websocket is not connected")
+        sync_id = str(next(self.sync_id_counter))
         content = {
             'syncId': sync_id,
-            'main': command_name,
-            'content': json.dumps(data)
+            'command': command_name,
+            'subCommand': subcommand,
+            'content': data or {}
         }
-        if subcommand:
-            content['subcommand'] = subcommand
-        await self.ws_connection.send_json(content)
         future = self.loop.create_future()
         self.wait_response_future[sync_id] = future
-        result = await future
-        del self.wait_response_future[sync_id]
-        del future
+        try:
+            await self.ws_connection.send_json(content, dumps=codec.dumps)
+            result = await asyncio.wait_for(future, self.api_timeout if timeout is None else timeout)
+        finally:  # 超时或被取消时同样需要清理
+            self.wait_response_future.pop(sync_id, None)
+        error_check(result)
         return result['data'] if "data" in result else result
 
     async def send_handle(
             self,
             action: str,
             method: str,
-            data: Optional[dict] = None
+            data: Optional[dict] = None,
+            *,
+            timeout: Optional[float] = None
     ):
         if not self.bot_session.verifyKey:
             raise ValueError
         data = data or dict()
+        if (
+                self.api_transport == "websocket"
+                and method in {"GET", "get", "POST", "update"}
+                and self.ws_connection
+                and not self.ws_connection.closed
+        ):
+            return await self.ws_send_handle(
+                action.replace("/", "_"),
+                data,
+                method if method in {"get", "update"} else None,
+                timeout=timeout
+            )
+        client_timeout = aiohttp.ClientTimeout(total=self.api_timeout if timeout is None else timeout)
         if method in {"GET", "get"}:
-            async with self.client_session.get(
-                    URL(f"{self.bot_session.host}/{action}").with_query(data)
+            async with self.get_session().get(
+                    URL(f"{self.bot_session.host}/{action}").with_query(data), timeout=client_timeout
             ) as response:
                 response.raise_for_status()
-                response_data = await response.json()
+                response_data = await response.json(loads=codec.loads)
         elif method in {"POST", "update"}:
-            async with self.client_session.post(
-                    URL(f"{self.bot_session.host}/{action}"), data=json.dumps(data)
+            async with self.get_session().post(
+                    URL(f"{self.bot_session.host}/{action}"),
+                    data=codec.dumps_bytes(data),
+                    headers={"Content-Type": "application/json"},
+                    timeout=client_timeout
             ) as response:
                 response.raise_for_status()
-                response_data = await response.json()
+                response_data = await response.json(loads=codec.loads)
         else:
             form = aiohttp.FormData()
-            for k, v in data:
-                form.add_fields(k, v)
-            async with self.client_session.post(
-                    URL(f"{self.bot_session.host}/{action}"), data=form
-            ) as response:
-                response.raise_for_status()
-                response_data = await response.json()
+            files: List[UploadFile] = []
+            try:
+                for key, value in data.items():
+                    if isinstance(value, (str, int, float)):
+                        form.add_field(key, str(value))
+                        continue
+                    if not isinstance(value, UploadFile):
+                        value = UploadFile(value)
+                    files.append(value)
+                    form.add_field(
+                        key, value.open(), filename=value.filename, content_type="application/octet-stream"
+                    )
+                async with self.get_session().post(
+                        URL(f"{self.bot_session.host}/{action}"), data=form, timeout=client_timeout
+                ) as response:
+                    response.raise_for_status()
+                    response_data = await response.json(loads=codec.loads)
+            finally:
+                for file in files:
+                    file.close()
         resp = response_data['data'] if "data" in response_data else response_data
         error_check(response_data)
         return resp
@@ -172,14 +413,20 @@ class Communicator:
         if "syncId" in unknown_event_data:
             data, sync_id = unknown_event_data.get("data"), unknown_event_data.get("syncId")
             if sync_id == "-1":
+                error_check(data)
                 event = await self.parse_to_event(data)
+                self.bot.relationship.apply(event)
                 with enter_context(bot=self.bot, event_i=event):
                     self.event_system.event_spread(event)
             elif sync_id in self.wait_response_future:
-                self.wait_response_future.pop(sync_id).set_result(data)
+                future = self.wait_response_future.pop(sync_id)
+                if not future.done():
+                    future.set_result(data)
 
             else:
                 self.logger.warning(f"syncId {sync_id} not found!")
+        else:
+            await self.receive_handle(unknown_event_data)
 
     async def receive_handle(self, unknown_event_data: dict):
         received_data = unknown_event_data.get('data')
@@ -192,7 +439,7 @@ class Communicator:
         query = {"qq": self.bot_session.account, "verifyKey": self.bot_session.verifyKey}
         if self.bot_session.single_mode:
             del query['qq']
-        async with self.client_session.ws_connect(str(URL(f"{self.bot_session.host}/all").with_query(query)), autoping=False) as connection:
+        async with self.get_session().ws_connect(str(URL(f"{self.bot_session.host}/all").with_query(query)), autoping=False) as connection:
             self.logger.debug("connecting to websocket")
             self.ws_connection = connection
             connected = False
@@ -212,13 +459,12 @@ class Communicator:
                         self.logger.warning("websocket: cancelled, stop")
                         return await self.stop()
                 if ws_message.type is WSMsgType.TEXT:
-                    received_data: dict = json.loads(ws_message.data)
                     if connected:
-                        try:
-                            await self.receive_handle(received_data)
-                        except Exception as e:
-                            self.logger.exception(f"receive_data has error {e}")
-                    elif not received_data['syncId']:
+                        if not await self.ingest_queue.put(ws_message.data):
+                            self.logger.warning("websocket: ingest queue is full, frame dropped")
+                        continue
+                    received_data: dict = codec.loads(ws_message.data)
+                    if not received_data['syncId']:
                         data = received_data['data']
                         if data['code']:
                             error_check(data)
@@ -226,6 +472,7 @@ class Communicator:
                         elif not self.bot_session.sessionKey:
                             self.bot_session.sessionKey = data.get("session")
                             connected = True
+                            self.start_workers()
                 elif ws_message.type is WSMsgType.CLOSE:
                     self.logger.info("websocket: server close connection.")
                     return
@@ -241,8 +488,69 @@ class Communicator:
         self.logger.info("connection disconnected")
 
     async def connect(self):
-        if not self.client_session:
-            self.client_session = ClientSession()
+        self.get_session()
         if not self.running_task or self.running_task.done():
             self.running = True
             self.running_task = self.loop.create_task(self.websocket())
+
+
+if __name__ == "__main__":
+    """
+    事件解析的基准测试: 回放一段录制的 websocket 数据帧
+    """
+    frames = [
+        {"type": "GroupMessage", "messageChain": [
+            {"type": "Source", "id": 123456, "time": 1638000000},
+            {"type": "At", "target": 1234567890, "display": "@Cesloi"},
+            {"type": "Plain", "text": " 今天天气怎么样"}
+        ], "sender": {
+            "id": 3165388245, "memberName": "RF-Tar-Railt", "specialTitle": "", "permission": "OWNER",
+            "joinTimestamp": 1600000000, "lastSpeakTimestamp": 1638000000, "muteTimeRemaining": 0,
+            "group": {"id": 123456789, "name": "Cesloi测试群", "permission": "ADMINISTRATOR"}
+        }},
+        {"type": "FriendMessage", "messageChain": [
+            {"type": "Source", "id": 123457, "time": 1638000001},
+            {"type": "Plain", "text": "Hello"},
+            {"type": "Image", "imageId": "{01E9451B-70ED-EAE3-B37C-101F1EEBF5B5}.jpg",
+             "url": "https://gchat.qpic.cn/gchatpic_new/0/0-0-01E9451B70EDEAE3B37C101F1EEBF5B5/0"}
+        ], "sender": {"id": 3165388245, "nickname": "RF-Tar-Railt", "remark": ""}},
+        {"type": "MemberCardChangeEvent", "origin": "old", "current": "new", "member": {
+            "id": 3165388245, "memberName": "RF-Tar-Railt", "permission": "MEMBER",
+            "group": {"id": 123456789, "name": "Cesloi测试群", "permission": "ADMINISTRATOR"}
+        }},
+        {"type": "NudgeEvent", "fromId": 3165388245, "action": "戳了戳", "suffix": "的脸", "target": 1234567890,
+         "subject": {"id": 123456789, "kind": "Group"}},
+    ]
+    stream = frames * 5000
+
+    def legacy(data: dict):
+        event_class = search_event(data["type"])
+        return event_class.parse_obj({k: v for k, v in data.items() if k != "type"})
+
+    communicator = Communicator.__new__(Communicator)
+    communicator.decode_options = DecodeOptions()
+
+    async def current():
+        for frame in stream:
+            await communicator.parse_to_event(frame)
+
+    start = time.perf_counter()
+    for f in stream:
+        legacy(f)
+    before = time.perf_counter() - start
+    start = time.perf_counter()
+    asyncio.run(current())
+    after = time.perf_counter() - start
+    communicator.decode_options = DecodeOptions(trusted_upstream=True)
+    start = time.perf_counter()
+    asyncio.run(current())
+    trusted = time.perf_counter() - start
+    from arclet.cesloi.model.cache import IdentityMap
+    communicator.decode_options = DecodeOptions(trusted_upstream=True, identity_map=IdentityMap())
+    start = time.perf_counter()
+    asyncio.run(current())
+    interned = time.perf_counter() - start
+    print(f"search_event + copy: {len(stream) / before:.0f} events/s")
+    print(f"event_type_map:      {len(stream) / after:.0f} events/s")
+    print(f"trusted upstream:    {len(stream) / trusted:.0f} events/s")
+    print(f"+ identity map:      {len(stream) / interned:.0f} events/s")
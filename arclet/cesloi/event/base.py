@@ -1,13 +1,21 @@
+from typing import Dict, Type
 from arclet.letoderea.entities.event import TemplateEvent
 from pydantic.class_validators import validator
 from ..utils import Structured
 
 from .inserter import ApplicationInserter, EventInserter
 
+event_type_map: Dict[str, Type["MiraiEvent"]] = {}
+"""事件名称到事件类的映射, 在事件类定义时自动注册"""
+
 
 class MiraiEvent(Structured, TemplateEvent):
     type: str
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        event_type_map[cls.__name__] = cls
+
     @classmethod
     @validator("type", allow_reuse=True)
     def type_limit(cls, v):
@@ -0,0 +1,159 @@
+"""
+定时任务与事件处理函数的执行方式
+
+协程函数默认在事件循环中执行; 同步函数默认放入线程池执行, 不会阻塞其他消息的处理;
+计算密集的函数可以指定放入进程池执行
+"""
+import asyncio
+import contextvars
+import functools
+import importlib
+import inspect
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from enum import Enum
+from typing import Callable, Optional, Dict, Union, Any
+
+
+class ExecutionMode(str, Enum):
+    """函数的执行方式"""
+    auto = "auto"  # 协程函数在事件循环中执行, 同步函数放入线程池
+    loop = "loop"  # 在事件循环中执行
+    thread = "thread"  # 放入线程池执行
+    process = "process"  # 放入进程池执行
+
+
+def _call(func: Callable, args: tuple, kwargs: dict) -> Any:
+    """在工作线程/进程中调用函数; 协程函数在新的事件循环中运行"""
+    if inspect.iscoroutinefunction(func):
+        return asyncio.run(func(*args, **kwargs))
+    return func(*args, **kwargs)
+
+
+def _call_by_reference(module: str, qualname: str, args: tuple, kwargs: dict) -> Any:
+    """在子进程中按 模块名.限定名 找到函数并调用"""
+    target: Any = importlib.import_module(module)
+    for name in qualname.split("."):
+        target = getattr(target, name)
+    target = getattr(target, "callable_target", target)  # 被注册为 Subscriber 的函数
+    return _call(inspect.unwrap(target), args, kwargs)
+
+
+class _PoolStats:
+    __slots__ = ("max_workers", "submitted", "completed", "failed")
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        in_flight = self.submitted - self.completed
+        return {
+            "max_workers": self.max_workers,
+            "active": min(in_flight, self.max_workers),
+            "queued": max(in_flight - self.max_workers, 0),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "saturation": in_flight / self.max_workers,
+        }
+
+
+class ExecutorManager:
+    """
+    管理线程池与进程池, 并将函数包装为按指定方式执行的协程函数
+
+    进程池中的函数按 模块名.限定名 在子进程中重新导入, 因此必须定义在模块顶层; 参数与返回值需要可以被 pickle
+
+    Args:
+        max_threads: 线程池的大小, 默认为 min(32, CPU 数 + 4)
+        max_processes: 进程池的大小, 默认为 CPU 数
+    """
+
+    def __init__(self, max_threads: Optional[int] = None, max_processes: Optional[int] = None):
+        cpu_count = os.cpu_count() or 1
+        self.max_threads = max_threads or min(32, cpu_count + 4)
+        self.max_processes = max_processes or cpu_count
+        self._pools: Dict[ExecutionMode, Executor] = {}
+        self._stats: Dict[ExecutionMode, _PoolStats] = {
+            ExecutionMode.thread: _PoolStats(self.max_threads),
+            ExecutionMode.process: _PoolStats(self.max_processes),
+        }
+
+    def _pool(self, mode: ExecutionMode) -> Executor:
+        if mode not in self._pools:
+            if mode is ExecutionMode.thread:
+                self._pools[mode] = ThreadPoolExecutor(self.max_threads, thread_name_prefix="cesloi_executor")
+            else:
+                self._pools[mode] = ProcessPoolExecutor(self.max_processes)
+        return self._pools[mode]
+
+    @staticmethod
+    def resolve(func: Callable, mode: Union[ExecutionMode, str] = ExecutionMode.auto) -> ExecutionMode:
+        """确定函数实际使用的执行方式"""
+        mode = ExecutionMode(mode)
+        if mode is ExecutionMode.auto:
+            return ExecutionMode.loop if inspect.iscoroutinefunction(func) else ExecutionMode.thread
+        return mode
+
+    async def run(self, mode: ExecutionMode, func: Callable, *args, **kwargs) -> Any:
+        """在指定的池中执行 func"""
+        loop = asyncio.get_running_loop()
+        if mode is ExecutionMode.thread:
+            call = functools.partial(contextvars.copy_context().run, _call, func, args, kwargs)
+        else:
+            func = inspect.unwrap(func)
+            call = functools.partial(_call_by_reference, func.__module__, func.__qualname__, args, kwargs)
+        stats = self._stats[mode]
+        stats.submitted += 1
+        try:
+            return await loop.run_in_executor(self._pool(mode), call)
+        except Exception:
+            stats.failed += 1
+            raise
+        finally:
+            stats.completed += 1
+
+    def wrap(self, func: Callable, mode: Union[ExecutionMode, str] = ExecutionMode.auto) -> Callable:
+        """
+        将函数包装为按指定方式执行的协程函数; 包装后的函数保留原函数的签名, 以便事件系统解析参数
+
+        Args:
+            func: 要包装的函数
+            mode: 执行方式
+        """
+        mode = self.resolve(func, mode)
+        if mode is ExecutionMode.loop:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.run(mode, func, *args, **kwargs)
+
+        return wrapper
+
+    def metrics(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """返回各个池的大小、正在执行与排队的数量以及饱和度"""
+        return {mode.value: stats.metrics() for mode, stats in self._stats.items()}
+
+    def shutdown(self, wait: bool = True):
+        """关闭已创建的池; 之后再次使用时会重新创建"""
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.shutdown(wait=wait)
+
+
+_executor = ExecutorManager()
+
+
+def set_executor(executor: ExecutorManager) -> ExecutorManager:
+    """替换全局使用的执行器, 例如调整池的大小"""
+    global _executor
+    _executor = executor
+    return executor
+
+
+def get_executor() -> ExecutorManager:
+    return _executor
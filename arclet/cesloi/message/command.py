@@ -1,5 +1,6 @@
-from typing import List, Union, Tuple, Optional
+from typing import List, Union, Tuple, Optional, Dict, Pattern, Callable, Any, Iterator
 from enum import Enum
+import os
 import re
 
 
@@ -38,6 +39,9 @@ class Subcommand:
             return [self.name + self.separate + sub for sub in result] + [self.name]
 
 
+_group_reference = re.compile(r"\(\?P[<=]|\(\?\(|\\[1-9]")  # 命名分组, 反向引用与条件分组
+
+
 class Command:
     """命令/命令参数解析器
 
@@ -59,12 +63,42 @@ class Command:
     """
     headers: Optional[List[str]]
     main: Optional[Subcommand]
+    pattern: Optional[Pattern]
+    patterns: Optional[List[Pattern]]
+    alternatives: Dict[int, Tuple[int, int]]
 
     def __init__(self, headers: Optional[List[str]] = None, main: Optional[list] = None):
         if not headers and not main:
             raise ValueError("Must choose one parameter!")
         self.headers = headers or [""]
         self.main = self.to_subcommand(main) if main else None
+        self.pattern = None
+        self.patterns = None
+        self.alternatives = {}
+        if self.main:
+            self.compile()
+
+    def compile(self):
+        """将 main 展开后的全部模式合并为一个正则, 每个模式用一个命名分组包裹
+
+        alternatives 记录每个包裹分组的序号, 以及其内部分组的数量;
+        模式中含有命名分组或反向引用时无法合并, 改为逐个编译, 按顺序匹配
+        """
+        contents = self.main.analysis_content()
+        if not any(_group_reference.search(pat) for pat in contents):
+            parts = []
+            group_index = 1
+            try:
+                for i, pat in enumerate(contents):
+                    count = re.compile(pat).groups
+                    parts.append(f"(?P<_{i}>{pat})")
+                    self.alternatives[group_index] = (group_index, count)
+                    group_index += count + 1
+                self.pattern = re.compile(f"^(?:{'|'.join(parts)})$")
+                return
+            except re.error:
+                self.alternatives = {}
+        self.patterns = [re.compile(f"^{pat}$") for pat in contents]
 
     def to_subcommand(self, cl):
         if not cl:
@@ -89,14 +123,151 @@ class Command:
             if head != "" and head in cmd:
                 cmd = cmd.replace(head, "", 1)
                 break
-        cmd = cmd.lstrip(' ')
+        return self.match_main(cmd.lstrip(' '))
+
+    def match_main(self, cmd: str) -> Union[str, Tuple[str], bool]:
+        """用命令主体匹配已去除命令头的文本, 返回值与 analysis 相同"""
         if not self.main:
             return cmd == ""
-        for pat in self.main.analysis_content():
-            pattern = re.compile(f'^{pat}$')
-            if result := pattern.findall(cmd):
-                return True if result[0] == cmd else result[0]
-        return False
+        if self.patterns is not None:
+            for pattern in self.patterns:
+                if result := pattern.findall(cmd):
+                    return True if result[0] == cmd else result[0]
+            return False
+        if not (result := self.pattern.match(cmd)):
+            return False
+        start, count = self.alternatives[result.lastindex]  # 包裹分组最后闭合, 即为 lastindex
+        if count == 0:
+            return True
+        groups = tuple("" if g is None else g for g in result.groups()[start:start + count])
+        if count == 1:
+            return True if groups[0] == cmd else groups[0]
+        return groups
+
+
+class _TrieNode:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.values: List[Any] = []
+
+    def insert(self, key: str) -> "_TrieNode":
+        node = self
+        for char in key:
+            node = node.children.setdefault(char, _TrieNode())
+        return node
+
+    def prefixes(self, text: str) -> Iterator[Tuple[int, List[Any]]]:
+        """由长到短给出所有是 text 前缀的键的结束位置与对应的值"""
+        found = [(0, self.values)] if self.values else []
+        node = self
+        for pos, char in enumerate(text):
+            if not (node := node.children.get(char)):
+                break
+            if node.values:
+                found.append((pos + 1, node.values))
+        return reversed(found)
+
+
+_regex_meta = set(".^$*+?{}[]|()\\")
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+    return False
+
+
+def _literal_prefix(pattern: str) -> str:
+    """正则开头的字面量部分, 用于预先筛选命令; 顶层含有 | 时开头并非必需, 返回空字符串"""
+    if _has_top_level_alternation(pattern):
+        return ""
+    prefix = ""
+    for char in pattern:
+        if char in _regex_meta:
+            if char in "*?{" and prefix:  # 量词作用于前一个字符
+                prefix = prefix[:-1]
+            break
+        prefix += char
+    return prefix
+
+
+def _command_prefix(command: Command) -> str:
+    """命令主体展开后全部模式共有的字面量开头"""
+    if not command.main:
+        return ""
+    prefixes = [_literal_prefix(pat) for pat in command.main.analysis_content()]
+    return os.path.commonprefix(prefixes) if prefixes else ""
+
+
+class CommandRouter:
+    """多命令路由器
+
+    将所有已注册命令的命令头合并为一棵前缀树, 每个命令头下再以命令主体开头的字面量建树;
+    一次调用即可找出匹配的命令, 返回其处理函数与解析结果
+
+    与 Command.analysis 不同, 路由器只在文本开头匹配命令头; 命令头为空的命令则直接匹配命令主体.
+    多个命令可匹配时, 优先选择更长的命令头, 其次是更长的主体字面量, 最后按注册顺序
+
+    样例:
+        router = CommandRouter()
+
+        @router.register(Command(headers=["bot"], main=["签到"]))
+        def sign(result): ...
+
+        handler, result = router.route("bot 签到")
+    """
+    headers: _TrieNode
+    commands: List[Tuple[Command, Callable]]
+
+    def __init__(self):
+        self.headers = _TrieNode()
+        self.commands = []
+
+    def register(self, command: Command, handler: Optional[Callable] = None):
+        """注册一个命令与其处理函数; 不传入 handler 时可作为装饰器使用"""
+        def wrapper(func: Callable):
+            self.commands.append((command, func))
+            main_prefix = _command_prefix(command)
+            for head in dict.fromkeys(command.headers):
+                header_node = self.headers.insert(head)
+                if not header_node.values:
+                    header_node.values.append(_TrieNode())
+                header_node.values[0].insert(main_prefix).values.append((command, func))
+            return func
+
+        return wrapper(handler) if handler else wrapper
+
+    def route(self, text: str) -> Optional[Tuple[Callable, Union[str, Tuple[str], bool]]]:
+        """匹配文本, 返回 (处理函数, 解析结果); 没有命令匹配时返回 None"""
+        text = text.rstrip(' ')
+        for end, (mains,) in self.headers.prefixes(text):
+            rest = text[end:].lstrip(' ')
+            for _, candidates in mains.prefixes(rest):
+                for command, handler in candidates:
+                    if (result := command.match_main(rest)) is not False:
+                        return handler, result
+        return None
+
+    def __len__(self):
+        return len(self.commands)
 
 
 AnyStr = Argument.AnyStr.value
@@ -131,3 +302,84 @@ if __name__ == "__main__":
     print(v.analysis("/ping 127.0.0.1 -t 10"))
     print(v.analysis("/ping 127.0.0.1"))
     print(v.analysis("/ping 127.0.0.1 -a"))
+
+    """
+    基准测试: 逐条编译匹配与预编译匹配
+    """
+    import time
+
+    def legacy_analysis(command: Command, cmd: str):
+        cmd = cmd.rstrip(' ')
+        for head in command.headers:
+            if head != "" and head in cmd:
+                cmd = cmd.replace(head, "", 1)
+                break
+        cmd = cmd.lstrip(' ')
+        if not command.main:
+            return cmd == ""
+        for pat in command.main.analysis_content():
+            pattern = re.compile(f'^{pat}$')
+            if result := pattern.findall(cmd):
+                return True if result[0] == cmd else result[0]
+        return False
+
+    commands = [
+        Command(main=["img", [["download", ["-p", AnyStr]], ["upload", [["-u", AnyStr], ["-f", AnyStr]]]]]),
+        Command(headers=['bot', 'cmd.'], main=["", [["签到"], ["sign in"]], ""]),
+        Command(main=[f"/ping {AnyStr}", [["-t", Digit], ["-a"]]]),
+        Command(headers=["cmd."], main=[f"{AnyStr}天气", [["-d", Digit]]]),
+        Command(main=[".roll", [["-n", Digit], ["-s", Digit]]]),
+        Command(main=[".ban", [["-u", Digit], ["-t", Digit]]]),
+        Command(main=[f"/echo {AnyStr}"]),
+        Command(main=[f"/music {Album}", [["-p", Album], ["-q", Digit]]]),
+    ] * 4
+    corpus = [
+        "img upload -u http://www.baidu.com", "cmd.sign in", "/ping 127.0.0.1 -t 10", "cmd.北京天气 -d 3",
+        ".roll -n 6", ".ban -u 123456 -t 600", "/echo 你好, 世界", "/music hello -p netease",
+        "今天吃什么", "有人在吗", "[图片]", "哈哈哈哈哈哈",
+    ] * 25
+    for name, analyse in (("legacy", legacy_analysis), ("compiled", Command.analysis)):
+        assert all(analyse(c, t) == Command.analysis(c, t) for c in commands for t in corpus)
+        start = time.perf_counter()
+        for text in corpus:
+            for c in commands:
+                analyse(c, text)
+        cost = time.perf_counter() - start
+        print(f"{name:>8}: {len(corpus) * len(commands) / cost:.0f} analyses/s")
+
+    """
+    基准测试: 逐个命令匹配与路由器匹配
+    """
+    import random
+
+    for size in (10, 100, 1000):
+        commands = []
+        for i in range(size):
+            if i % 2:
+                commands.append(Command(headers=[f"bot{i % 7}."], main=[f"cmd{i}", [["-n", Digit], ["-s", AnyStr]]]))
+            else:
+                commands.append(Command(main=[f"/cmd{i}", [["-n", Digit], ["-s", AnyStr]]]))
+        router = CommandRouter()
+        for c in commands:
+            router.register(c, lambda result: result)
+        rand = random.Random(size)
+        corpus = []
+        for _ in range(2000):
+            i = rand.randrange(size)
+            if rand.random() < 0.5:
+                corpus.append(rand.choice(["今天吃什么", "有人在吗", "[图片]", "哈哈哈哈哈哈", "/help"]))
+            elif i % 2:
+                corpus.append(f"bot{i % 7}. cmd{i} -n {rand.randrange(100)}")
+            else:
+                corpus.append(f"/cmd{i} -s hello")
+        start = time.perf_counter()
+        for text in corpus:
+            for c in commands:
+                if c.analysis(text) is not False:
+                    break
+        naive = time.perf_counter() - start
+        start = time.perf_counter()
+        for text in corpus:
+            router.route(text)
+        routed = time.perf_counter() - start
+        print(f"{size:>4} commands: each Command {len(corpus) / naive:.0f} msg/s, router {len(corpus) / routed:.0f} msg/s")
@@ -1,11 +1,11 @@
-import json as JSON
 from xml import sax
 from enum import Enum
 from pathlib import Path
-from typing import Dict, Optional, TYPE_CHECKING, Union, List
+from typing import Dict, Optional, TYPE_CHECKING, Union, List, Type
 from base64 import b64decode, b64encode
-from ..utils import Structured
-import aiohttp
+from ..utils import Structured, http_request
+from .. import codec
+from .media_cache import get_media_cache
 from pydantic import validator, Field
 from abc import ABC
 
@@ -13,14 +13,22 @@ if TYPE_CHECKING:
     from .messageChain import MessageChain
 
 
+element_type_map: Dict[str, Type["MessageElement"]] = {}
+"""元素名称到元素类的映射, 在元素类定义时自动注册"""
+
+
 class MessageElement(ABC, Structured):
     type: str
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        element_type_map[cls.__name__] = cls
+
     def __hash__(self):
         return hash((type(self),) + tuple(self.__dict__.values()))
 
     def to_serialization(self) -> str:
-        return f"[mirai:{self.type}:{JSON.dumps(self.dict(exclude={'type'}))}]".replace('\n', '\\n').replace('\t',
+        return f"[mirai:{self.type}:{codec.dumps(self.dict(exclude={'type'}))}]".replace('\n', '\\n').replace('\t',
                                                                                                              '\\t')
 
     @staticmethod
@@ -35,18 +43,30 @@ class MediaElement(MessageElement):
     url: Optional[str] = None
     base64: Optional[str] = None
 
+    def cache_key(self) -> Optional[str]:
+        """在多媒体缓存中使用的键"""
+        return self.url
+
+    async def _download(self) -> bytes:
+        async with http_request("GET", self.url) as response:
+            if response.status != 200:
+                raise ConnectionError(response.status, await response.text())
+            return await response.read()
+
     async def get_bytes(self) -> bytes:
-        if self.url and not self.base64:
-            async with aiohttp.request("GET", self.url) as response:
-                if response.status != 200:
-                    raise ConnectionError(response.status, await response.text())
-                data = await response.content.readexactly(response.content_length)
-                self.base64 = str(b64encode(data), encoding='utf-8')
-                return data
+        """获取元素的原始字节; 通过 url 下载的内容保存在共用的多媒体缓存中, 而不是元素自身"""
         if self.base64:
             return b64decode(self.base64)
+        key = self.cache_key()
+        if not key:
+            return None
+        cache = get_media_cache()
+        if not self.url:
+            return await cache.load(key)
+        return await cache.fetch(key, self._download)
 
     def to_sendable(self, path: Optional[Union[Path, str]] = None, data_bytes: Optional[bytes] = None):
+        """将内容以 base64 嵌入元素中; 较大的文件请使用 Cesloi.upload_image 等方法以流的形式上传后再发送"""
         if sum([bool(self.url), bool(path), bool(self.base64)]) > 1:
             raise ValueError("Too many binary initializers!")
         if path:
@@ -188,14 +208,14 @@ class Json(MessageElement):
 
     def __init__(self, json: Union[dict, str], **kwargs) -> None:
         if isinstance(json, dict):
-            json = JSON.dumps(json)
+            json = codec.dumps(json)
         super().__init__(json=json, **kwargs)
 
     def to_text(self) -> str:
         return "[JSON消息]"
 
     def get_json(self) -> dict:
-        return JSON.loads(self.Json)
+        return codec.loads(self.Json)
 
     @staticmethod
     def from_json(json: Dict):
@@ -207,10 +227,10 @@ class App(MessageElement):
     content: str
 
     def to_text(self) -> str:
-        return f"[APP消息:{JSON.loads(self.content)['prompt']}]"
+        return f"[APP消息:{codec.loads(self.content)['prompt']}]"
 
     def get_meta_content(self) -> dict:
-        return JSON.loads(self.content)['meta']
+        return codec.loads(self.content)['meta']
 
     @staticmethod
     def from_json(json: Dict):
@@ -305,6 +325,9 @@ class Image(MediaElement):
         )
         self.to_sendable(path, data_bytes)
 
+    def cache_key(self) -> Optional[str]:
+        return self.imageId or self.url
+
     def to_text(self) -> str:
         return "[图片]"
 
@@ -364,6 +387,9 @@ class Voice(MediaElement):
         )
         self.to_sendable(path, data_bytes)
 
+    def cache_key(self) -> Optional[str]:
+        return self.voiceId or self.url
+
     def to_text(self) -> str:
         return "[语音]"
 
@@ -390,6 +416,15 @@ class MusicShare(MessageElement):
         return MusicShare.parse_obj(json)
 
 
+class Unknown(MessageElement):
+    """无法识别的消息元素, 会保留上游提供的全部字段"""
+    type: str
+
+    @staticmethod
+    def from_json(json: Dict):
+        return Unknown.parse_obj(json)
+
+
 class ForwardNode(Structured):
     """表示合并转发中的一个节点"""
     senderId: int
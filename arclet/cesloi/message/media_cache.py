@@ -0,0 +1,260 @@
+"""
+多媒体元素共用的字节缓存
+
+以 url 或图片/语音 id 为键, 在内存中按 LRU 保存原始字节, 超出容量的条目可以溢出到磁盘;
+同一键的并发下载只会发起一次. 在事件循环中运行时, 磁盘的读写在线程池中进行, 不会阻塞消息的处理
+"""
+import asyncio
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Callable, Awaitable, Union
+
+from ..executor import get_executor, ExecutionMode
+
+
+def _retrieve(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()  # 写入失败的条目在读取时会被丢弃
+
+
+class MediaCache:
+    """有容量上限的 LRU 字节缓存
+
+    Args:
+        max_size: 内存中缓存的总字节数上限
+        spill_dir: 溢出到磁盘时使用的目录, 为 None 时被淘汰的条目直接丢弃
+        spill_max_size: 磁盘上缓存的总字节数上限
+    """
+
+    def __init__(
+            self,
+            max_size: int = 64 * 1024 * 1024,
+            spill_dir: Optional[Union[Path, str]] = None,
+            spill_max_size: int = 512 * 1024 * 1024
+    ):
+        self.max_size = max_size
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.spill_max_size = spill_max_size
+        self.size = 0
+        self.spill_size = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._spilled: "OrderedDict[str, int]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._writing: Dict[str, bytes] = {}  # 正在写入磁盘的条目
+        self._io: Optional[asyncio.Task] = None  # 最后提交的磁盘操作
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self.deduplicated = 0
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+
+    def _spill_path(self, key: str) -> Path:
+        return self.spill_dir / hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _disk(self, func: Callable, *args) -> Optional[asyncio.Task]:
+        """
+        提交一次磁盘操作; 有运行中的事件循环时按提交顺序在线程池中执行, 否则直接执行
+
+        Args:
+            func: 进行磁盘操作的函数
+            args: 函数的参数
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            func(*args)
+            return None
+        previous = self._io
+        if previous and (previous.done() or previous.get_loop() is not loop):
+            previous = None
+
+        async def run():
+            if previous:
+                await asyncio.wait([previous])
+            await get_executor().run(ExecutionMode.thread, func, *args)
+
+        self._io = loop.create_task(run())
+        self._io.add_done_callback(_retrieve)
+        return self._io
+
+    def _written(self, key: str, data: bytes):
+        if self._writing.get(key) is data:
+            del self._writing[key]
+
+    def _spill(self, key: str, data: bytes):
+        if not self.spill_dir or len(data) > self.spill_max_size:
+            return
+        self._drop_spilled(key)
+        self._spilled[key] = len(data)
+        self.spill_size += len(data)
+        task = self._disk(self._spill_path(key).write_bytes, data)
+        if task:
+            self._writing[key] = data
+            task.add_done_callback(lambda _: self._written(key, data))
+        while self.spill_size > self.spill_max_size:
+            self._drop_spilled(next(iter(self._spilled)))
+
+    def _drop_spilled(self, key: str):
+        if key in self._spilled:
+            self.spill_size -= self._spilled.pop(key)
+            self._writing.pop(key, None)
+            self._disk(self._spill_path(key).unlink, True)
+
+    def _read_spilled(self, key: str) -> Optional[bytes]:
+        try:
+            return self._spill_path(key).read_bytes()
+        except OSError:
+            return None
+
+    def _get_memory(self, key: str) -> Optional[bytes]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        if key in self._writing:
+            data = self._writing[key]
+            self.spill_hits += 1
+            self.put(key, data)
+            return data
+        return None
+
+    def _restore(self, key: str, data: Optional[bytes]) -> Optional[bytes]:
+        if key not in self._spilled:  # 读取期间条目已被替换或淘汰
+            return self._get_memory(key)
+        if data is None:
+            self._drop_spilled(key)
+            return None
+        self.spill_hits += 1
+        self.put(key, data)
+        return data
+
+    def get(self, key: str) -> Optional[bytes]:
+        """取出缓存的字节, 磁盘上的条目会被重新放回内存; 在协程中请使用 load, 以免读取磁盘时阻塞事件循环"""
+        data = self._get_memory(key)
+        if data is None and key in self._spilled:
+            data = self._restore(key, self._read_spilled(key))
+        if data is None:
+            self.misses += 1
+        return data
+
+    async def load(self, key: str) -> Optional[bytes]:
+        """与 get 相同, 但磁盘上的条目在线程池中读取"""
+        data = self._get_memory(key)
+        if data is None and key in self._spilled:
+            data = self._restore(key, await get_executor().run(ExecutionMode.thread, self._read_spilled, key))
+        if data is None:
+            self.misses += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """放入缓存; 超出容量时按最近最少使用的顺序淘汰"""
+        self.discard(key)
+        if len(data) > self.max_size:
+            self._spill(key, data)
+            return
+        self._drop_spilled(key)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            old_key, old_data = self._entries.popitem(last=False)
+            self.size -= len(old_data)
+            self._spill(old_key, old_data)
+
+    def discard(self, key: str):
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key))
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+        for key in list(self._spilled):
+            self._drop_spilled(key)
+
+    async def flush(self):
+        """等待已提交的磁盘操作全部完成"""
+        if self._io and self._io.get_loop() is asyncio.get_running_loop():
+            await asyncio.wait([self._io])
+
+    async def fetch(self, key: str, fetcher: Callable[[], Awaitable[bytes]]) -> bytes:
+        """从缓存中取出字节, 未命中时调用 fetcher 获取; 同一键的并发调用共享同一次获取
+
+        Args:
+            key: 缓存的键
+            fetcher: 获取原始字节的协程函数
+        """
+        data = await self.load(key)
+        if data is not None:
+            return data
+        if key in self._pending:
+            self.deduplicated += 1
+            return await asyncio.shield(self._pending[key])
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            data = await fetcher()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 没有其他等待者时不产生警告
+            raise
+        else:
+            self.put(key, data)
+            future.set_result(data)
+            return data
+        finally:
+            del self._pending[key]
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "spilled": len(self._spilled),
+            "spill_size": self.spill_size,
+            "hits": self.hits,
+            "spill_hits": self.spill_hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+        }
+
+
+_media_cache = MediaCache()
+
+
+def set_media_cache(cache: MediaCache) -> MediaCache:
+    """替换全局使用的多媒体缓存, 例如调整容量或启用磁盘溢出"""
+    global _media_cache
+    _media_cache = cache
+    return cache
+
+
+def get_media_cache() -> MediaCache:
+    return _media_cache
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    async def main():
+        calls = 0
+
+        async def fetcher():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return b"\x89PNG" + bytes(1020)
+
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cache = MediaCache(max_size=4096, spill_dir=spill_dir)
+            results = await asyncio.gather(*[cache.fetch("http://example.com/a.png", fetcher) for _ in range(100)])
+            print(f"100 concurrent fetches -> {calls} download(s), {len({id(i) for i in results})} object(s)")
+            for i in range(8):
+                cache.put(f"img{i}", bytes(1024))
+            await cache.flush()
+            print(await cache.load("img0") is not None, cache.metrics())
+
+    asyncio.run(main())
@@ -1,15 +1,27 @@
-from typing import List, Iterable, Type, Union
+from typing import List, Iterable, Type, Union, Dict, Optional
 
-from arclet.cesloi.message.element import MessageElement, _update_forward_refs, Source, Quote, File
+from pydantic import PrivateAttr
+
+from arclet.cesloi.message.element import MessageElement, _update_forward_refs, Source, Quote, File, Unknown, \
+    element_type_map
 from ..utils import Structured
 
 
 class MessageChain(Structured):
     """
     即 "消息链", 用于承载整个消息内容的数据结构, 包含有一有序列表, 包含有继承了 MessageElement 的类实例.
+
+    消息链会缓存元素类型到位置的索引与渲染后的文本; 请通过消息链的方法修改内容,
+    直接修改 `__root__` 或其中的元素后需自行调用 `_invalidate`
+
+    `copy_self`, `replace`, `replace_text` 得到的消息链与原消息链共享元素 (写时复制), 二者互不影响
     """
 
     __root__: List[MessageElement]
+    _index: Optional[Dict[Type[MessageElement], List[int]]] = PrivateAttr(None)
+    _text: Optional[str] = PrivateAttr(None)
+    _only_text: Optional[str] = PrivateAttr(None)
+    _shared: bool = PrivateAttr(False)
 
     @staticmethod
     def element_class_generator(target=MessageElement):
@@ -20,24 +32,28 @@ class MessageChain(Structured):
 
     @staticmethod
     def search_element(name: str):
-        for i in MessageChain.element_class_generator():
-            if i.__name__ == name:
-                return i
+        return element_type_map.get(name)
 
     @staticmethod
-    def build_chain(obj: List[Union[dict, MessageElement]]):
+    def build_chain(obj: List[Union[dict, MessageElement]], trusted: bool = False):
         elements = []
         for i in obj:
             if isinstance(i, MessageElement):
                 elements.append(i)
             elif isinstance(i, dict) and "type" in i:
-                elements.append(MessageChain.search_element(i["type"]).parse_obj(i))
+                element_class = element_type_map.get(i["type"], Unknown)
+                elements.append(element_class.parse_trusted(i) if trusted else element_class.parse_obj(i))
         return elements
 
     @classmethod
     def parse_obj(cls: Type["MessageChain"], obj: List[Union[dict, MessageElement]]) -> "MessageChain":
         return cls(__root__=cls.build_chain(obj))  # 默认是不可变型
 
+    @classmethod
+    def parse_trusted(cls: Type["MessageChain"], obj: List[Union[dict, MessageElement]]) -> "MessageChain":
+        """跳过校验, 从可信的上游数据构造消息链"""
+        return cls.construct(__root__=cls.build_chain(obj, trusted=True))
+
     def __init__(self, __root__: Iterable[MessageElement]):
         super().__init__(__root__=self.build_chain(list(__root__)))
 
@@ -54,13 +70,47 @@ class MessageChain(Structured):
                 element_list.extend(list(ele))
         return cls(__root__=element_list)
 
+    def _invalidate(self):
+        """消息链的内容被修改后, 清除缓存的索引与文本"""
+        self._index = None
+        self._text = None
+        self._only_text = None
+
+    def _writable(self) -> List[MessageElement]:
+        """返回可以原地修改的元素列表; 若列表与其他消息链共享, 先复制一份"""
+        self._invalidate()
+        if self._shared:
+            self.__root__ = list(self.__root__)
+            self._shared = False
+        return self.__root__
+
+    def _derive(self, elements: Optional[List[MessageElement]] = None) -> "MessageChain":
+        """不经校验地创建新的消息链; 不提供元素时与本消息链共享元素列表与缓存"""
+        if elements is not None:
+            return self.__class__.construct(__root__=elements)
+        new_message = self.__class__.construct(__root__=self.__root__)
+        new_message._index, new_message._text, new_message._only_text = self._index, self._text, self._only_text
+        new_message._shared = self._shared = True
+        return new_message
+
+    def _type_index(self) -> Dict[Type[MessageElement], List[int]]:
+        """元素类型到其在消息链中位置的索引, 在首次查询时建立"""
+        if self._index is None:
+            index = {}
+            for i, element in enumerate(self.__root__):
+                index.setdefault(type(element), []).append(i)
+            self._index = index
+        return self._index
+
     def to_text(self) -> str:
         """获取以字符串形式表示的消息链, 且趋于通常你见到的样子.
 
         Returns:
             str: 以字符串形式表示的消息链
         """
-        return "".join(i.to_text() for i in self.__root__)
+        if self._text is None:
+            self._text = "".join(i.to_text() for i in self.__root__)
+        return self._text
 
     def to_serialization(self) -> str:
         """获取可序列化的字符串形式表示的消息链, 会存储所有的信息.
@@ -79,7 +129,9 @@ class MessageChain(Structured):
     def only_text(self) -> str:
         """获取消息链中的纯文字部分
         """
-        return "".join(i.to_text() if i else "" for i in self.findall("Plain"))
+        if self._only_text is None:
+            self._only_text = "".join(i.to_text() if i else "" for i in self.findall("Plain"))
+        return self._only_text
 
     def is_instance(self, element_type: Union[str, Type[MessageElement]]) -> bool:
         if isinstance(element_type, str):
@@ -95,7 +147,7 @@ class MessageChain(Structured):
         """返回消息链内可能的所有指定元素"""
         if isinstance(element_type, str):
             element_type = MessageChain.search_element(element_type)
-        return [i for i in self.__root__ if type(i) is element_type]
+        return [self.__root__[i] for i in self._type_index().get(element_type, ())]
 
     def find(self, element_type: Union[str, Type[MessageElement]], index: int = 0) -> Union[bool, MessageElement]:
         """
@@ -106,23 +158,28 @@ class MessageChain(Structured):
             element_type : 指定的元素类型
             index: 位置索引, 默认为0
         """
-        ele = self.findall(element_type)
-        return ele[index] if ele else False
+        if isinstance(element_type, str):
+            element_type = MessageChain.search_element(element_type)
+        positions = self._type_index().get(element_type)
+        return self.__root__[positions[index]] if positions else False
 
     def has(self, element_type: Union[str, Type[MessageElement]]) -> bool:
         """
         当消息链内有指定元素时返回True
         无则返回False
         """
-        ele = self.findall(element_type)
-        return bool(ele)
+        if isinstance(element_type, str):
+            element_type = MessageChain.search_element(element_type)
+        return element_type in self._type_index()
 
     def pop(self, index: int) -> MessageElement:
-        return self.__root__.pop(index)
+        return self._writable().pop(index)
 
     def index(self, element_type: Union[str, Type[MessageElement]]) -> int:
-        if ele := self.find(element_type):
-            return self.__root__.index(ele)
+        if isinstance(element_type, str):
+            element_type = MessageChain.search_element(element_type)
+        if positions := self._type_index().get(element_type):
+            return positions[0]
         else:
             raise ValueError(f"{element_type} is not in this MessageChain")
 
@@ -139,19 +196,13 @@ class MessageChain(Structured):
         """
         if isinstance(element_type, str):
             element_type = MessageChain.search_element(element_type)
-        new_message = MessageChain(self.__root__)
-        if not counts:
-            for i, v in enumerate(self.__root__):
-                if type(v) is element_type:
-                    new_message.__root__[i] = new_element
-        elif counts > 0:
-            for i, v in enumerate(self.__root__):
-                if type(v) is element_type:
-                    counts -= 1
-                    new_message.__root__[i] = new_element
-                if counts == 0:
-                    break
-        return new_message
+        positions = self._type_index().get(element_type)
+        if not positions or (counts is not None and counts < 0):
+            return self._derive()
+        elements = list(self.__root__)
+        for i in (positions[:counts] if counts else positions):
+            elements[i] = new_element
+        return self._derive(elements)
 
     def replace_text(self, old_text: str, new_text: str, counts: int = -1) -> "MessageChain":
         """替换消息链中可能含有的文本消息中的文本为指定文本；不改变消息链本身
@@ -163,12 +214,16 @@ class MessageChain(Structured):
         Returns:
             MessageChain: 新的消息链
         """
-        new_message = MessageChain(self.__root__)
         from arclet.cesloi.message.element import Plain
-        for ele in new_message:
-            if isinstance(ele, Plain):
-                ele.text = ele.text.replace(old_text, new_text, counts)
-        return new_message
+        elements = None
+        for i in self._type_index().get(Plain, ()):
+            ele = self.__root__[i]
+            text = ele.text.replace(old_text, new_text, counts)
+            if text != ele.text:
+                if elements is None:
+                    elements = list(self.__root__)
+                elements[i] = ele.copy(update={"text": text})  # 不修改共享的元素
+        return self._derive(elements)
 
     def remove(self, element_type: Union[str, Type[MessageElement]], counts: int = None):
         """删除消息链中的所有指定的消息元素类型
@@ -182,18 +237,18 @@ class MessageChain(Structured):
         if isinstance(element_type, str):
             element_type = MessageChain.search_element(element_type)
         if not counts:
+            self._invalidate()
             self.__root__ = [i for i in self.__root__ if type(i) is not element_type]
+            self._shared = False
         elif counts > 0:
+            root = self._writable()
             i = 0
-            while counts:
-                if type(self.__root__[i]) is element_type:
-                    try:
-                        self.__root__.remove(self.__root__[i])
-                        counts -= 1
-                        i -= 1
-                    except ValueError:
-                        break
-                i += 1
+            while counts and i < len(root):
+                if type(root[i]) is element_type:
+                    del root[i]
+                    counts -= 1
+                else:
+                    i += 1
         return self
 
     def only_save(self, element_type: Union[str, Type[MessageElement]]):
@@ -206,7 +261,9 @@ class MessageChain(Structured):
         """
         if isinstance(element_type, str):
             element_type = MessageChain.search_element(element_type)
+        self._invalidate()
         self.__root__ = [i for i in self.__root__ if type(i) is element_type]
+        self._shared = False
         return self
 
     def insert(self, index: int, element: MessageElement):
@@ -217,7 +274,7 @@ class MessageChain(Structured):
         Returns:
             操作完成后的消息链本身
         """
-        self.__root__.insert(index, element)
+        self._writable().insert(index, element)
         return self
 
     def append(self, element: MessageElement):
@@ -228,7 +285,7 @@ class MessageChain(Structured):
         Returns:
             操作完成后的消息链本身
         """
-        self.__root__.append(element)
+        self._writable().append(element)
         return self
 
     def extend(self, *elements: Union[MessageElement, List[MessageElement]]):
@@ -238,21 +295,21 @@ class MessageChain(Structured):
                 element_list.append(ele)
             else:
                 element_list.extend(ele)
-        self.__root__ += element_list
+        self._writable().extend(element_list)
         return self
 
     def copy_self(self) -> "MessageChain":
-        return MessageChain(self.__root__)
+        return self._derive()
 
     def __add__(self, other) -> "MessageChain":
         if isinstance(other, MessageElement):
-            self.__root__.append(other)
+            self._writable().append(other)
             return self
         elif isinstance(other, MessageChain):
-            self.__root__.extend(i for i in other.__root__ if i.type != "Source")
+            self._writable().extend(i for i in other.__root__ if i.type != "Source")
             return self
         elif isinstance(other, List):
-            self.__root__ += other
+            self._writable().extend(other)
             return self
 
     def __repr__(self) -> str:
@@ -272,7 +329,8 @@ class MessageChain(Structured):
         是否包含特定元素类型/字符串
         """
         if isinstance(item, str):
-            return item in self.find("Plain").to_text()
+            plain = self.find("Plain")
+            return bool(plain) and item in plain.to_text()
         else:
             return self.has(item)
 
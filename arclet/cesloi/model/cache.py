@@ -0,0 +1,245 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, List, Union, Hashable, Type, Tuple, Any
+
+from pydantic import BaseModel
+
+from .relation import Friend, Group, Member, Permission
+
+class IdentityMap:
+    """
+    入站数据中 Group, Member 与 Friend 的规范实例表, 以 id 为键, 按 LRU 淘汰
+
+    同一 id 的数据再次出现时, 内容未变化则直接复用已有实例, 否则原地更新已有实例后复用;
+    因此同一个群/成员/好友在各个事件中是同一个对象, 可以用 is 比较;
+    这也意味着已经收到的事件中的实体会随之后的数据改变, 需要保留当时的状态时请自行复制 (如 .copy())
+
+    Args:
+        maxsize: 保留的实例数量上限
+    """
+    kinds = (Group, Member, Friend)
+    _plans: Dict[Type[BaseModel], List[Tuple[str, str, type]]] = {}
+
+    def __init__(self, maxsize: int = 16384):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Tuple[Any, ...], Tuple[dict, BaseModel]]" = OrderedDict()
+        self.hits: int = 0
+        self.updates: int = 0
+        self.misses: int = 0
+
+    @classmethod
+    def _plan(cls, model: Type[BaseModel]) -> List[Tuple[str, str, type]]:
+        plan = cls._plans.get(model)
+        if plan is None:
+            plan = cls._plans[model] = [
+                (field.name, field.alias, field.type_) for field in model.__fields__.values()
+                if not field.sub_fields and field.type_ in cls.kinds
+            ]
+        return plan
+
+    @staticmethod
+    def _key(model: type, data: dict) -> Optional[Tuple[Any, ...]]:
+        try:
+            if model is Member:
+                return Member, data["group"]["id"], data["id"]
+            return model, data["id"]
+        except (KeyError, TypeError):
+            return None
+
+    def decode(self, model: Type[BaseModel], data: Any, trusted: bool = False) -> BaseModel:
+        """
+        解析 data; Group, Member 与 Friend 本身及其类型的字段使用规范实例
+
+        Args:
+            model: 目标模型
+            data: 入站数据
+            trusted: 是否跳过校验直接构造, 参考 utils.DecodeOptions
+        """
+        if model in self.kinds and isinstance(data, dict):
+            return self.resolve(model, data, trusted)
+        return self.parse(model, data, trusted)
+
+    def parse(self, model: Type[BaseModel], data: Any, trusted: bool = False) -> BaseModel:
+        interned = {}
+        if isinstance(data, dict) and self._plan(model):
+            data = dict(data)
+            for name, alias, kind in self._plan(model):
+                if isinstance(data.get(alias), dict):
+                    data[alias] = interned[name] = self.resolve(kind, data[alias], trusted)
+        obj = model.parse_trusted(data) if trusted else model.parse_obj(data)
+        obj.__dict__.update(interned)  # 校验时模型可能被复制, 换回规范实例
+        return obj
+
+    def resolve(self, model: type, data: dict, trusted: bool = False) -> BaseModel:
+        """返回 data 对应的规范实例"""
+        key = self._key(model, data)
+        if key is None:
+            return self.parse(model, data, trusted)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            if entry[0] == data:
+                self.hits += 1
+                return entry[1]
+        obj = self.parse(model, data, trusted)
+        if entry is not None:
+            canonical = entry[1]
+            for name in obj.__fields_set__:  # 只合并载荷中出现的字段, 未出现的字段保留原值
+                canonical.__dict__[name] = obj.__dict__[name]
+            object.__setattr__(canonical, "__fields_set__", canonical.__fields_set__ | obj.__fields_set__)
+            self.updates += 1
+        else:
+            canonical = obj
+            self.misses += 1
+        self._entries[key] = (data, canonical)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return canonical
+
+    def clear(self):
+        self._entries.clear()
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "updates": self.updates,
+            "misses": self.misses,
+        }
+
+
+class RelationshipCache:
+    """
+    好友、群与群成员的内存缓存, 以 id 为索引
+
+    各列表在首次请求时从上游整体拉取, 之后由入站事件增量更新, 超过 ttl 后再次整体刷新
+
+    Args:
+        ttl: 整体刷新的间隔, 单位为秒; 小于等于0时不会过期
+    """
+
+    def __init__(self, ttl: float = 600.0):
+        self.ttl = ttl
+        self.friends: Dict[int, Friend] = {}
+        self.groups: Dict[int, Group] = {}
+        self.members: Dict[int, Dict[int, Member]] = {}
+        self.loaded: Dict[Hashable, float] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+        self.event_updates: int = 0
+
+    def fresh(self, key: Hashable) -> bool:
+        """key 为 "friends", "groups" 或 ("members", 群号)"""
+        loaded = self.loaded.get(key)
+        if loaded is None or (self.ttl > 0 and time.monotonic() - loaded > self.ttl):
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def set_friends(self, friends: List[Friend]):
+        self.friends = {i.id: i for i in friends}
+        self.loaded["friends"] = time.monotonic()
+
+    def set_groups(self, groups: List[Group]):
+        self.groups = {i.id: i for i in groups}
+        self.loaded["groups"] = time.monotonic()
+
+    def set_members(self, group_id: int, members: List[Member]):
+        self.members[group_id] = {i.id: i for i in members}
+        self.loaded["members", group_id] = time.monotonic()
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """使指定的列表失效, 不指定时使全部列表失效"""
+        if key is None:
+            self.loaded.clear()
+        else:
+            self.loaded.pop(key, None)
+
+    def apply(self, event) -> None:
+        """根据入站事件更新缓存"""
+        updater = getattr(self, f"_on_{event.type}", None)
+        if updater:
+            updater(event)
+            self.event_updates += 1
+
+    def _member_table(self, group: Group) -> Optional[Dict[int, Member]]:
+        return self.members.get(group.id) if ("members", group.id) in self.loaded else None
+
+    def _update_member(self, member: Member, **values):
+        table = self._member_table(member.group)
+        cached = table.get(member.id) if table is not None else None
+        for target in {id(member): member, id(cached): cached}.values():
+            if target is not None:
+                for k, v in values.items():
+                    setattr(target, k, v)
+
+    def _on_MemberJoinEvent(self, event):
+        table = self._member_table(event.member.group)
+        if table is not None:
+            table[event.member.id] = event.member
+
+    def _on_MemberLeaveEventKick(self, event):
+        table = self._member_table(event.member.group)
+        if table is not None:
+            table.pop(event.member.id, None)
+
+    _on_MemberLeaveEventQuit = _on_MemberLeaveEventKick
+
+    def _on_MemberCardChangeEvent(self, event):
+        self._update_member(event.member, name=event.current)
+
+    def _on_MemberSpecialTitleChangeEvent(self, event):
+        self._update_member(event.member, specialTitle=event.current)
+
+    def _on_MemberPermissionChangeEvent(self, event):
+        self._update_member(event.member, permission=Permission(event.current))
+
+    def _on_MemberMuteEvent(self, event):
+        self._update_member(event.member, muteTimeRemaining=event.durationSeconds)
+
+    def _on_MemberUnmuteEvent(self, event):
+        self._update_member(event.member, muteTimeRemaining=0)
+
+    def _update_group(self, group: Group, **values):
+        targets = [group, self.groups.get(group.id)]
+        targets.extend(i.group for i in (self._member_table(group) or {}).values())
+        for target in {id(i): i for i in targets if i is not None}.values():
+            for k, v in values.items():
+                setattr(target, k, v)
+
+    def _on_GroupNameChangeEvent(self, event):
+        self._update_group(event.group, name=event.current)
+
+    def _on_BotGroupPermissionChangeEvent(self, event):
+        self._update_group(event.group, accountPerm=event.current)
+
+    def _on_BotJoinGroupEvent(self, event):
+        if "groups" in self.loaded:
+            self.groups[event.group.id] = event.group
+
+    def _on_BotLeaveEventActive(self, event):
+        self.groups.pop(event.group.id, None)
+        self.members.pop(event.group.id, None)
+        self.loaded.pop(("members", event.group.id), None)
+
+    _on_BotLeaveEventKick = _on_BotLeaveEventActive
+
+    def _on_FriendNickChangedEvent(self, event):
+        cached = self.friends.get(event.friend.id)
+        for target in {id(event.friend): event.friend, id(cached): cached}.values():
+            if target is not None:
+                target.nickname = event.name_to
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        return {
+            "friends": len(self.friends),
+            "groups": len(self.groups),
+            "member_tables": len(self.members),
+            "members": sum(len(i) for i in self.members.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            "event_updates": self.event_updates,
+        }
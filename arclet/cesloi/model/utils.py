@@ -1,7 +1,7 @@
-import aiohttp
 from pathlib import Path
 from .relation import Group, Friend
-from typing import Optional, Literal, Union
+from ..utils import http_request
+from typing import Optional, Literal, Union, Dict, Tuple
 from pydantic import BaseModel
 
 
@@ -9,6 +9,19 @@ class BotMessage(BaseModel):
     messageId: int
 
 
+class BroadcastResult(BaseModel):
+    """批量发送的结果, 以 ("group", 群号), ("friend", QQ号) 或 ("temp", 群号, QQ号) 为键"""
+    succeeded: Dict[Tuple[Union[str, int], ...], BotMessage] = {}
+    failed: Dict[Tuple[Union[str, int], ...], Exception] = {}
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
 class Profile(BaseModel):
     nickname: str
     email: Optional[str]
@@ -54,7 +67,7 @@ class FileInfo(BaseModel):
             raise AttributeError("cannot download")
         try:
             with save_path.open("wb") as f_obj:
-                async with aiohttp.request("GET", self.downloadInfo.url) as resp:
+                async with http_request("GET", self.downloadInfo.url) as resp:
                     async for result in resp.content:
                         f_obj.write(result)
         except Exception as e:
@@ -1,11 +1,16 @@
 import os
 import sys
-from types import ModuleType
-from typing import Optional, Dict, Union, Type, Callable, List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType, FunctionType
+from typing import Optional, Dict, Union, Type, Callable, List, Tuple
 import importlib
+import importlib.util
 from ..letoderea import EventSystem, TemplateEvent, EventDelegate, Publisher, Subscriber, Condition_T, \
     TemplateDecorator, search_event, event_class_generator
 from .logger import Logger
+from .timing.schedule import Toconada
+from . import codec
 
 
 class TemplatePlugin:
@@ -22,6 +27,38 @@ class TemplatePlugin:
         self.usage = usage or ""
 
 
+class LazyPlugin(Publisher):
+    """
+    尚未导入的插件的占位发布器
+
+    以最高的优先级参与分发; 插件订阅的事件首次到达时导入插件, 之后移除自身.
+    插件注册到已有发布器上的订阅器会在本次分发中被正常调用, 新建的发布器则由这里转交本次的事件
+    """
+
+    def __init__(self, bellidin: Type["Bellidin"], module_name: str, events: List[str]):
+        super().__init__(priority=-sys.maxsize)
+        self.bellidin = bellidin
+        self.module_name = module_name
+        self.events = set(events)
+
+    def on_event(self, event_system: EventSystem):
+        target = event_system.current_event
+        event_name = target.get('type') if isinstance(target, dict) else target.__class__.__name__
+        if event_name not in self.events:
+            return
+        existing = set(map(id, event_system.publisher_list))
+        if not self.bellidin.load_lazy_plugin(self.module_name):
+            return
+        publishers = [
+            pub for pub in event_system.publisher_list
+            if id(pub) not in existing
+            and all(condition.judge(target) for condition in pub.external_conditions)
+        ]
+        publishers.sort(key=lambda x: x.priority)
+        for pub in publishers:
+            pub.on_event(event_system)
+
+
 class Bellidin:
     """
     贝利丁(Bellidin), Cesloi的哥哥
@@ -29,11 +66,16 @@ class Bellidin:
     Cesloi的插件管理器
      - set_bellidin: 初始化管理器，通常不需要管
      - install_plugin: 载入单个模块，需要提供相对路径
-     - install_plugins: 载入文件夹下的所有模块，需要提供相对路径
+     - install_plugins: 载入文件夹下的所有模块，需要提供相对路径; 可选择在插件订阅的事件首次到达时才导入插件
     """
     ignore = ["__init__.py", "__pycache__"]
+    manifest_name = ".bellidin_manifest.json"
     _modules: Dict[str, "TemplatePlugin"] = {}
     _module_target_dict: Dict[str, list] = {}
+    _module_events: Dict[str, List[str]] = {}
+    _lazy_plugins: Dict[str, LazyPlugin] = {}
+    _module_side_effects: Dict[str, List[str]] = {}
+    load_report: Dict[str, Dict[str, float]] = {}
     current_module_name: str
     event_system: EventSystem
     logger: Logger.logger
@@ -83,6 +125,8 @@ class Bellidin:
                 cls._module_target_dict[cls.current_module_name] = [[event, subscriber]]
             else:
                 cls._module_target_dict[cls.current_module_name].append([event, subscriber])
+            module_events = cls._module_events.setdefault(cls.current_module_name, [])
+            module_events.extend(e.__name__ for e in events if e.__name__ not in module_events)
             return func
 
         return register_wrapper
@@ -101,6 +145,7 @@ class Bellidin:
                     if not pub.internal_delegate:
                         cls.event_system.remove_publisher(pub)
         del cls._module_target_dict[module_name]
+        cls._module_events.pop(module_name, None)
 
     @classmethod
     def set_bellidin(cls, event_system, logger):
@@ -117,11 +162,15 @@ class Bellidin:
     def install_plugin(cls, modules_name: str):
         try:
             cls.current_module_name = modules_name
+            subscribers = set(map(id, cls._subscribers()))
+            start = time.perf_counter()
             module = importlib.import_module(modules_name, modules_name)
+            cls._module_side_effects[modules_name] = cls._side_effects(module, subscribers)
 
             name = getattr(module, '__name__', None)
             usage = getattr(module, '__usage__', None)
             cls._modules[modules_name] = TemplatePlugin(module, name, usage)
+            cls.load_report.setdefault(modules_name, {})["import"] = time.perf_counter() - start
             cls.logger.debug(f"plugin: {module.__name__} is installed")
             return True
         except Exception as e:
@@ -129,20 +178,196 @@ class Bellidin:
             return False
 
     @classmethod
-    def install_plugins(cls, plugin_dir: str):
-        cls.plugins_dir = plugin_dir
-        plugin_count = 0
-        for module in os.listdir(plugin_dir):
-            if module in cls.ignore:
+    def _subscribers(cls) -> List[Subscriber]:
+        return [
+            subscriber for pub in cls.event_system.publisher_list
+            for delegate in pub.internal_delegate.values() for subscriber in delegate.subscribers
+        ]
+
+    @classmethod
+    def _side_effects(cls, module: ModuleType, subscribers: set) -> List[str]:
+        """插件导入时除 model_register 之外的注册: 定时任务, 直接注册到事件系统的订阅器与 __init__ 钩子"""
+        effects = []
+        if cls._has_timing_jobs(module.__name__):
+            effects.append("timing")
+        own = {id(subscriber) for _, subscriber in cls._module_target_dict.get(module.__name__, [])}
+        if any(id(i) not in subscribers and id(i) not in own for i in cls._subscribers()):
+            effects.append("register")
+        if isinstance(module.__dict__.get("__init__"), FunctionType):
+            effects.append("__init__")
+        return effects
+
+    @staticmethod
+    def _has_timing_jobs(module_name: str) -> bool:
+        """插件及其子模块的全局变量中的 Toconada 是否有由插件中的函数定时的任务"""
+        prefix = module_name + "."
+
+        def is_own(name: Optional[str]) -> bool:
+            return bool(name) and (name == module_name or name.startswith(prefix))
+
+        for name, module in list(sys.modules.items()):
+            if not is_own(name):
                 continue
-            if os.path.isdir(module):
-                cls.install_plugin(f"{plugin_dir.replace('/', '.')}.{module}")
+            for value in list(vars(module).values()):
+                if isinstance(value, Toconada) and any(
+                        is_own(getattr(task.callable_target, "__module__", None)) for task in value.schedule_tasks
+                ):
+                    return True
+        return False
+
+    @classmethod
+    def _scan(cls, plugin_dir: str) -> List[Tuple[str, str]]:
+        """列出插件目录下的模块, 返回 (模块名, 路径)"""
+        plugins = []
+        for module in sorted(os.listdir(plugin_dir)):
+            path = os.path.join(plugin_dir, module)
+            if module in cls.ignore or module.startswith("."):
+                continue
+            if os.path.isdir(path):
+                plugins.append((f"{plugin_dir.replace('/', '.')}.{module}", path))
+            elif module.endswith(".py"):
+                plugins.append((f"{plugin_dir.replace('/', '.')}.{module[:-3]}", path))
+        return plugins
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        if not os.path.isdir(path):
+            return os.path.getmtime(path)
+        return max(
+            (os.path.getmtime(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files
+             if f.endswith(".py")),
+            default=0.0
+        )
+
+    @classmethod
+    def _prefetch(cls, module_names: List[str], workers: int):
+        """并发读取插件的源码并生成字节码缓存, 使之后的导入只需读取 .pyc"""
+        specs = []
+        for module_name in module_names:
+            try:
+                spec = importlib.util.find_spec(module_name)
+            except (ImportError, ValueError):
+                continue
+            if spec and spec.loader and hasattr(spec.loader, "get_code"):
+                specs.append(spec)
+
+        def fetch(spec):
+            start = time.perf_counter()
+            try:
+                spec.loader.get_code(spec.name)
+            except Exception:
+                pass  # 导入时会再次报告错误
+            return spec.name, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max(workers, 1), thread_name_prefix="bellidin_prefetch") as pool:
+            for module_name, cost in pool.map(fetch, specs):
+                cls.load_report.setdefault(module_name, {})["prefetch"] = cost
+
+    @classmethod
+    def install_plugins(
+            cls,
+            plugin_dir: str,
+            lazy: bool = False,
+            manifest: Optional[str] = None,
+            prefetch_workers: int = 8
+    ):
+        """
+        载入文件夹下的所有模块
+
+        Args:
+            plugin_dir: 插件目录的相对路径
+            lazy: 是否延迟导入; 为 True 时插件只在其订阅的事件首次到达时才被导入,
+                插件订阅的事件记录在清单文件中, 插件文件有变化或不在清单中时仍会立即导入以更新清单.
+                延迟导入只适用于仅通过 model_register 订阅事件的插件: 导入时还会定时任务 (通过插件的全局变量中的 Toconada),
+                直接向事件系统注册订阅器 (如 bot.register) 或定义了 __init__ 钩子的插件, 以及没有订阅任何事件的插件,
+                总是立即导入. 这些副作用只能在导入时被发现, 因此插件以其他方式产生导入副作用时 (如启动后台任务), 不应使用延迟导入
+            manifest: 清单文件的路径, 默认为插件目录下的 .bellidin_manifest.json
+            prefetch_workers: 立即导入前并发读取源码与字节码的线程数
+        """
+        cls.plugins_dir = plugin_dir
+        cls.load_report = {}
+        start = time.perf_counter()
+        plugins = cls._scan(plugin_dir)
+        manifest = manifest or os.path.join(plugin_dir, cls.manifest_name)
+        entries: Dict[str, dict] = {}
+        if lazy and os.path.exists(manifest):
+            try:
+                with open(manifest, "rb") as f:
+                    entries = codec.loads(f.read()).get("plugins", {})
+            except Exception as e:
+                cls.logger.warning(f"plugin manifest {manifest} is ignored: {e}")
+        mtimes = {module_name: cls._mtime(path) for module_name, path in plugins}
+
+        deferred, eager = [], []
+        for module_name, _ in plugins:
+            entry = entries.get(module_name)
+            if (
+                    lazy and entry and entry.get("mtime") == mtimes[module_name]
+                    and entry.get("events") and not entry.get("side_effects")
+            ):
+                deferred.append((module_name, entry["events"]))
             else:
-                cls.install_plugin(f"{plugin_dir.replace('/', '.')}.{module.split('.')[0]}")
-            plugin_count += 1
-        cls.logger.info(f"{plugin_count} plugin have been installed")
+                eager.append(module_name)
+        if eager:
+            cls._prefetch(eager, prefetch_workers)
+        for module_name in eager:
+            cls.install_plugin(module_name)
+        for module_name, events in deferred:
+            placeholder = cls._lazy_plugins[module_name] = LazyPlugin(cls, module_name, events)
+            cls.event_system.publisher_list.append(placeholder)
+            cls.load_report.setdefault(module_name, {})["deferred"] = 1.0
+
+        if lazy and eager:
+            for module_name in eager:
+                entries[module_name] = {
+                    "mtime": mtimes[module_name],
+                    "events": cls._module_events.get(module_name, []),
+                    "side_effects": cls._module_side_effects.get(module_name, []),
+                }
+            try:
+                with open(manifest, "wb") as f:
+                    f.write(codec.dumps_bytes({"version": 1, "plugins": entries}))
+            except OSError as e:
+                cls.logger.warning(f"failed to write plugin manifest {manifest}: {e}")
+
+        plugin_count = len(plugins)
+        cls.logger.info(
+            f"{plugin_count} plugin have been installed in {time.perf_counter() - start:.3f}s"
+            + (f", {len(deferred)} of them will be imported on first use" if deferred else "")
+        )
+        for module_name, report in sorted(
+                cls.load_report.items(), key=lambda x: x[1].get("import", 0.0), reverse=True
+        ):
+            if "deferred" in report:
+                continue
+            cls.logger.debug(
+                f"plugin: {module_name} prefetch {report.get('prefetch', 0.0) * 1000:.1f}ms, "
+                f"import {report.get('import', 0.0) * 1000:.1f}ms"
+            )
         return plugin_count
 
+    @classmethod
+    def load_lazy_plugin(cls, module_name: str) -> bool:
+        """立即导入一个延迟导入的插件"""
+        placeholder = cls._lazy_plugins.pop(module_name, None)
+        if placeholder is None:
+            return module_name in cls._modules
+        if placeholder in cls.event_system.publisher_list:
+            cls.event_system.remove_publisher(placeholder)
+        cls.load_report.get(module_name, {}).pop("deferred", None)
+        if cls.install_plugin(module_name):
+            cls.logger.debug(
+                f"plugin: {module_name} is imported on first use "
+                f"in {cls.load_report[module_name]['import'] * 1000:.1f}ms"
+            )
+            return True
+        return False
+
+    @classmethod
+    def get_load_report(cls) -> Dict[str, Dict[str, float]]:
+        """返回各插件的启动耗时, 单位为秒; prefetch 为读取源码与字节码, import 为导入, deferred 表示尚未导入"""
+        return cls.load_report
+
     @classmethod
     def get_plugins(cls):
         return cls._modules
@@ -155,6 +380,10 @@ class Bellidin:
             if file == "__pycache__":
                 for pyc in os.listdir(f"{cls.plugins_dir}/__pycache__"):
                     os.remove(f"{cls.plugins_dir}/__pycache__/{pyc}")
+        for placeholder in cls._lazy_plugins.values():
+            if placeholder in cls.event_system.publisher_list:
+                cls.event_system.remove_publisher(placeholder)
+        cls._lazy_plugins.clear()
         for module_name in _names:
             cls.logger.debug(f"plugin: {module_name} uninstalling")
             cls._uninstall_subscriber(module_name)
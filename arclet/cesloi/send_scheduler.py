@@ -0,0 +1,276 @@
+"""
+位于 send_*_message 之前的发送调度器
+
+每个会话对象的消息按顺序逐条发送, 并受到该会话与全局的令牌桶限速;
+优先级数值越小越先发送, 可选地将短时间内发往同一对象的纯文本消息合并为一条
+"""
+import asyncio
+import contextvars
+import time
+from typing import Optional, Dict, Tuple, List, Callable, Awaitable, Any, Union, Hashable, Set
+
+from .message.element import Plain
+from .message.messageChain import MessageChain
+
+
+class TokenBucket:
+    """
+    令牌桶
+
+    Args:
+        rate: 每秒补充的令牌数, 小于等于0时不限速
+        burst: 桶的容量, 即允许的突发数量
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens: float = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """距离下一个令牌可用还需等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+
+class SendRequest:
+    __slots__ = ("key", "message", "sender", "priority", "coalesce", "future", "enqueued")
+
+    def __init__(
+            self,
+            key: Tuple[Hashable, ...],
+            message: MessageChain,
+            sender: Callable[[MessageChain], Awaitable[Any]],
+            priority: int,
+            coalesce: bool,
+            future: asyncio.Future
+    ):
+        self.key = key
+        self.message = message
+        self.sender = sender
+        self.priority = priority
+        self.coalesce = coalesce and all(type(i) is Plain for i in message)
+        self.future = future
+        self.enqueued = time.monotonic()
+
+
+class SendScheduler:
+    """
+    出站消息的发送调度器
+
+    Args:
+        global_rate: 全局每秒发送的消息数上限, 小于等于0时不限
+        global_burst: 全局允许的突发数量
+        group_rate: 每个群每秒发送的消息数上限
+        group_burst: 每个群允许的突发数量
+        friend_rate: 每个好友 (以及临时会话) 每秒发送的消息数上限
+        friend_burst: 每个好友允许的突发数量
+        coalesce_window: 合并纯文本消息的时间窗口, 单位为秒, 为0时不合并
+        coalesce_separator: 合并时使用的分隔符
+    """
+    rate_kinds = {"group": "group", "friend": "friend", "temp": "friend"}
+
+    def __init__(
+            self,
+            global_rate: float = 20.0,
+            global_burst: int = 20,
+            group_rate: float = 1.0,
+            group_burst: int = 5,
+            friend_rate: float = 1.0,
+            friend_burst: int = 5,
+            coalesce_window: float = 0.0,
+            coalesce_separator: str = "\n",
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.rates: Dict[str, Tuple[float, int]] = {
+            "group": (group_rate, group_burst),
+            "friend": (friend_rate, friend_burst),
+        }
+        self.coalesce_window = coalesce_window
+        self.coalesce_separator = coalesce_separator
+        self.buckets: Dict[Tuple[Hashable, ...], TokenBucket] = {}
+        self.queues: Dict[Tuple[Hashable, ...], List[SendRequest]] = {}
+        self.in_flight: set = set()
+        self.send_tasks: Set[asyncio.Task] = set()
+        self.submitted: int = 0
+        self.dispatched: int = 0
+        self.sent: int = 0
+        self.merged: int = 0
+        self.failed: int = 0
+        self.last_latency: float = 0.0
+        self.max_latency: float = 0.0
+        self.total_latency: float = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return sum(len(i) for i in self.queues.values())
+
+    def _bucket(self, key: Tuple[Hashable, ...]) -> TokenBucket:
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(*self.rates[self.rate_kinds.get(key[0], "friend")])
+        return self.buckets[key]
+
+    async def submit(
+            self,
+            key: Tuple[Hashable, ...],
+            message: MessageChain,
+            sender: Callable[[MessageChain], Awaitable[Any]],
+            *,
+            priority: int = 16,
+            coalesce: bool = True
+    ) -> Any:
+        """
+        将一条消息放入发送队列, 并等待其发送结果
+
+        Args:
+            key: 会话对象的标识, 如 ("group", 123456)
+            message: 要发送的消息链
+            sender: 实际发送消息链的协程函数; 消息被合并时, 只调用第一条消息的 sender
+            priority: 优先级, 数值越小越先发送
+            coalesce: 是否允许与相邻的纯文本消息合并
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            # 在空白的上下文中启动, 不继承首个提交者 (某个事件处理器) 的上下文变量
+            self._task = contextvars.Context().run(
+                loop.create_task, self._dispatch_loop(), name="cesloi_send_scheduler"
+            )
+        request = SendRequest(key, message, sender, priority, coalesce, loop.create_future())
+        queue = self.queues.setdefault(key, [])
+        index = len(queue)
+        while index and queue[index - 1].priority > priority:  # 同一对象内, 相同优先级的消息保持顺序
+            index -= 1
+        queue.insert(index, request)
+        self.submitted += 1
+        self._wakeup.set()
+        return await request.future
+
+    def _take(self, key: Tuple[Hashable, ...]) -> List[SendRequest]:
+        queue = self.queues[key]
+        batch = [queue.pop(0)]
+        if self.coalesce_window > 0 and batch[0].coalesce:
+            while queue and queue[0].coalesce and queue[0].priority == batch[0].priority:
+                request = queue.pop(0)
+                if not request.future.done():
+                    batch.append(request)
+        if not queue:
+            del self.queues[key]
+        return batch
+
+    def _hold(self, request: SendRequest, now: float) -> float:
+        """纯文本消息在合并窗口内等待后续消息的剩余时间"""
+        if self.coalesce_window > 0 and request.coalesce:
+            return max(request.enqueued + self.coalesce_window - now, 0.0)
+        return 0.0
+
+    async def _dispatch_loop(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait: Optional[float] = None
+            for key in sorted(
+                    (k for k, q in self.queues.items() if k not in self.in_flight),
+                    key=lambda k: (self.queues[k][0].priority, self.queues[k][0].enqueued)
+            ):
+                queue = self.queues[key]
+                while queue and queue[0].future.done():  # 等待者已取消
+                    queue.pop(0)
+                if not queue:
+                    del self.queues[key]
+                    continue
+                delay = self._hold(queue[0], now)
+                if delay <= 0:
+                    global_delay = self.global_bucket.delay(now)
+                    if global_delay > 0:
+                        wait = global_delay if wait is None else min(wait, global_delay)
+                        break
+                    delay = self._bucket(key).delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                self.global_bucket.consume(now)
+                self._bucket(key).consume(now)
+                self.in_flight.add(key)
+                task = asyncio.create_task(self._send(key, self._take(key), now))
+                self.send_tasks.add(task)
+                task.add_done_callback(self.send_tasks.discard)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, key: Tuple[Hashable, ...], batch: List[SendRequest], dispatched: float):
+        self.dispatched += len(batch)
+        for request in batch:
+            latency = dispatched - request.enqueued
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+        message = batch[0].message
+        if len(batch) > 1:
+            message = MessageChain.create(
+                self.coalesce_separator.join("".join(e.text for e in r.message) for r in batch)
+            )
+            self.merged += len(batch) - 1
+        try:
+            result = await batch[0].sender(message)
+        except Exception as e:
+            self.failed += len(batch)
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        else:
+            self.sent += 1
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_result(result)
+        finally:
+            self.in_flight.discard(key)
+            self._wakeup.set()
+
+    async def close(self):
+        """停止调度并等待正在发送的消息, 尚未发送的消息以 ConnectionError 结束"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.send_tasks:
+            await asyncio.gather(*self.send_tasks, return_exceptions=True)
+        for queue in self.queues.values():
+            for request in queue:
+                if not request.future.done():
+                    request.future.set_exception(ConnectionError("send scheduler closed"))
+        self.queues.clear()
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        """返回队列深度与排队延迟(单位为秒)等统计信息"""
+        return {
+            "pending": self.pending,
+            "in_flight": len(self.in_flight),
+            "submitted": self.submitted,
+            "dispatched": self.dispatched,
+            "sent": self.sent,
+            "merged": self.merged,
+            "failed": self.failed,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self.total_latency / self.dispatched if self.dispatched else 0.0,
+        }
@@ -1,72 +1,264 @@
 import asyncio
+import heapq
+import itertools
+import time
 from datetime import datetime, timedelta
-from typing import Optional, List
-from .timers import Timer
+from typing import Optional, List, Tuple, Dict, Any
+from .timers import Timer, MisfirePolicy
+from .store import JobStore, JobRecord
+from ..executor import ExecutionMode, get_executor
 
 from ...letoderea import EventSystem
 from ...letoderea.entities.condition import TemplateCondition
-from .task import TimingTask
+from .task import TimingTask, OverlapPolicy
 
 
 class Toconada:
     """
     托可娜达,莱恩家的姐姐，与妹妹一起住在Cesloi隔壁
 
-    用于非事件订阅器的调度器
+    用于非事件订阅器的调度器; 所有定时任务由同一个循环按最小堆调度, 使用 monotonic 时间
+
+    指定 store 时, 各任务的下一次执行时间与执行结果会被持久化; 重启后按记录恢复,
+    错过的执行按时间器的 misfire (没有时使用此处的 misfire) 处理, 已执行过的一次性任务不会再执行
 
     Args:
         event_system: 事件系统的实例
+        store: 任务存储, 参考timing.store
+        misfire: 时间器未指定时使用的错过执行的处理方式
     """
     event_system: EventSystem
     loop: asyncio.AbstractEventLoop
     schedule_tasks: List[TimingTask]
 
-    def __init__(self, event_system: EventSystem):
+    def __init__(
+            self,
+            event_system: EventSystem,
+            store: Optional[JobStore] = None,
+            misfire: MisfirePolicy = MisfirePolicy.run_once,
+    ):
         self.event_system = event_system
         self.loop = self.event_system.loop
         self.schedule_tasks = []
+        self.heap: List[Tuple[float, int, TimingTask, float]] = []  # (执行时间, 序号, 任务, 计划时间)
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.runner: Optional[asyncio.Task] = None
+        self.store = store
+        self.misfire = misfire
+        self.records: Dict[str, JobRecord] = store.load_all() if store else {}
+        self.dirty: Dict[str, Optional[JobRecord]] = {}  # 尚未写入的变更, None 表示删除记录
+        self.flusher: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
 
-    def timing(self, timer: Timer, is_disposable: Optional[bool] = False):
+    def timing(
+            self,
+            timer: Timer,
+            is_disposable: Optional[bool] = False,
+            job_id: Optional[str] = None,
+            mode: ExecutionMode = ExecutionMode.auto,
+            overlap: OverlapPolicy = OverlapPolicy.queue,
+            max_instances: int = 1,
+            jitter: float = 0.0,
+    ):
         """定时一个函数/方法
 
         Args:
             timer : 时间器实例, 参考timing.timers
             is_disposable: 是否只执行一次该函数/方法
+            job_id: 任务在任务存储中的标识, 默认为函数的 模块名.限定名
+            mode: 执行方式; 默认时同步函数放入线程池执行, 参考executor.ExecutionMode
+            overlap: 上一次执行尚未结束 (实例数已达上限) 时, 丢弃还是排队本次执行
+            max_instances: 允许同时执行的实例数
+            jitter: 每次执行附加的随机延迟的上限, 单位为秒; 用于错开同一时刻到期的大量任务
         """
         def wrapper(func):
-            task = TimingTask(
-                func, timer, self.event_system, is_disposable
-            )
-            self.schedule_tasks.append(task)
-            task.set_task()
+            self.add(TimingTask(
+                func, timer, self.event_system, is_disposable, job_id, mode,
+                overlap=overlap, max_instances=max_instances, jitter=jitter
+            ))
             return func
 
         return wrapper
 
+    def add(self, task: TimingTask):
+        """加入一个定时任务; 设置了任务存储时从记录中恢复"""
+        task.misfire = task.timer.misfire or self.misfire
+        self.schedule_tasks.append(task)
+        now = time.monotonic()
+        if self.store:
+            task.listener = self._record
+            self._push(task, self._restore(task, now))
+        else:
+            self._push(task, task.next_deadline(now))
+        if not self.runner or self.runner.done():
+            self.runner = self.loop.create_task(self.run())
+
+    def cancel(self, task: TimingTask):
+        """取消一个定时任务并删除其持久化记录; 堆中的记录在到期时才被丢弃, 存储中的记录由 flush 删除"""
+        task.stop()
+        task.listener = None
+        if task in self.schedule_tasks:
+            self.schedule_tasks.remove(task)
+        if self.store and self.records.pop(task.id, None):
+            self.dirty[task.id] = None
+            self._schedule_flush()
+
+    def _restore(self, task: TimingTask, now: float) -> Optional[float]:
+        record = self.records.get(task.id)
+        if record is None or record.timer != task.signature:
+            return task.next_deadline(now)
+        task.run_count = record.run_count
+        task.last_run, task.last_status, task.last_result = record.last_run, record.last_status, record.last_result
+        if task.is_disposable and record.finished:
+            return None
+        if record.next_run is None:
+            return task.next_deadline(now)
+        tz = getattr(task.timer, "tz", None)
+        delay = record.next_run - time.time()
+        if delay >= -task.timer.misfire_grace:
+            if not task.timer.period:
+                task.last_fire = datetime.fromtimestamp(record.next_run, tz)
+            return now + max(delay, 0.0)
+        policy = task.misfire
+        if policy is MisfirePolicy.skip:
+            return task.next_deadline(now)
+        if policy is MisfirePolicy.run_all and hasattr(task.timer, "next_fire"):
+            # 从第一次错过的执行开始逐次推算
+            task.last_fire = datetime.fromtimestamp(record.next_run, tz) - timedelta(seconds=1)
+            return task.next_deadline(now)
+        return now
+
+    def _record(self, task: TimingTask, next_run: Optional[float] = ...):
+        if not self.store:
+            return
+        record = self.records.get(task.id)
+        if record is None or record.timer != task.signature:
+            record = self.records[task.id] = JobRecord(task.id, task.signature)
+        elif next_run is ... or next_run == record.next_run or (
+                next_run is not None and record.next_run is not None and abs(next_run - record.next_run) < 1e-3
+        ):
+            if (
+                    record.run_count == task.run_count and record.last_run == task.last_run
+                    and record.last_status == task.last_status and record.last_result == task.last_result
+            ):
+                return  # 记录没有变化
+        if next_run is not ...:
+            record.next_run = next_run
+        record.last_run, record.last_status, record.last_result = task.last_run, task.last_status, task.last_result
+        record.run_count = task.run_count
+        record.finished = task.is_disposable and (task.run_count > 0 or task.is_running)
+        self.dirty[task.id] = record
+        self.wakeup.set()
+
+    async def flush(self):
+        """将尚未写入的变更批量写入任务存储; 写入在线程池中进行, 不阻塞事件循环"""
+        async with self.flush_lock:
+            while self.store and self.dirty:
+                dirty, self.dirty = self.dirty, {}
+                await get_executor().run(ExecutionMode.thread, self._write, dirty)
+
+    def _write(self, dirty: Dict[str, Optional[JobRecord]]):
+        # 只在 flush 中调用, flush_lock 保证任务存储同一时刻只被一个线程写入
+        records = [record for record in dirty.values() if record is not None]
+        if records:
+            self.store.save_many(records)
+        for job_id, record in dirty.items():
+            if record is None:
+                self.store.remove(job_id)
+
+    def _schedule_flush(self):
+        if self.dirty and (self.flusher is None or self.flusher.done()):
+            self.flusher = self.loop.create_task(self.flush())
+
+    def _push(self, task: TimingTask, deadline: Optional[float]):
+        task.deadline = deadline
+        if not task.is_stop and not task.recheck:
+            self._record(task, None if deadline is None else time.time() + deadline - time.monotonic())
+        if deadline is None:
+            task.check_finished()
+            return
+        fire_at = deadline if task.recheck else deadline + task.jitter_delay()
+        heapq.heappush(self.heap, (fire_at, next(self.counter), task, deadline))
+        if self.heap[0][2] is task:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            self._schedule_flush()
+            while self.heap and self.heap[0][2].deadline != self.heap[0][3]:  # 已取消或已改期
+                heapq.heappop(self.heap)
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            now = time.monotonic()
+            fire_at, _, task, _ = self.heap[0]
+            if fire_at > now:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), fire_at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.heap)
+            if task.recheck:
+                self._push(task, task.next_deadline(now))
+                continue
+            task.fire()
+            self._push(task, None if task.is_disposable else task.next_deadline(now))
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """返回各个任务的统计信息, 参考TimingTask.metrics"""
+        return {task.id: task.metrics() for task in self.schedule_tasks}
+
+    async def stop(self):
+        """停止调度并等待正在执行的任务结束"""
+        for task in self.schedule_tasks:
+            task.stop()
+        if self.runner:
+            self.runner.cancel()
+            try:
+                await self.runner
+            except asyncio.CancelledError:
+                pass
+            self.runner = None
+        self.heap.clear()
+        await asyncio.gather(*(task.join() for task in self.schedule_tasks))
+        await self.flush()
+
 
 class Toconado(TemplateCondition):
     """
     托可娜多,莱恩家的妹妹,与Cesloi玩得更好
 
-    用于事件订阅器的调度器
+    用于事件订阅器的调度器; 下一次允许响应的时间在上一次响应时预先算好, 每次事件只需比较一次时间戳
 
     Args:
             timer : 时间器实例, 参考timing.timers
     """
     timer: Timer
     last_run: Optional[datetime]
+    next_run: Optional[float]
 
     def __init__(self, timer: Timer):
         self.timer = timer
         self.last_run = None
+        self.next_run = None
+
+    def _next_run(self, now: float) -> Optional[float]:
+        period = self.timer.period
+        if period:
+            return now + period
+        if hasattr(self.timer, "next_fire"):
+            next_time = self.timer.next_fire(self.timer.now())
+        else:
+            next_time = next(iter(self.timer.get_delta()), None)
+        return next_time.timestamp() if next_time else None
 
-    def judge(self) -> bool:
-        if not self.last_run:
-            self.last_run = datetime.now()
-            return True
-        for interval in self.timer.get_delta():
-            now = datetime.now()
-            if self.last_run + (interval - now) <= now:
-                self.last_run = now.replace(microsecond=0)
-                return True
+    def judge(self, *args) -> bool:
+        now = time.time()
+        if self.last_run and (self.next_run is None or now < self.next_run):
             return False
+        self.last_run = datetime.now()
+        self.next_run = self._next_run(now)
+        return True
@@ -0,0 +1,157 @@
+"""
+定时任务的持久化存储
+
+记录每个任务的下一次执行时间 (unix 时间戳) 与上一次的执行结果, 使调度在重启后可以恢复;
+Toconada 在启动时一次性读取全部记录, 运行中的变更会合并后批量写入
+"""
+import abc
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Union
+
+from .. import codec
+
+
+class JobRecord:
+    """
+    一个定时任务的持久化记录
+
+    Args:
+        id: 任务的标识, 默认为函数的 模块名.限定名
+        timer: 时间器的描述; 与当前时间器不一致时 (即修改了定时设置) 记录中的时间会被忽略
+        next_run: 下一次执行的 unix 时间戳, None 表示没有计划中的执行
+        last_run: 上一次执行的 unix 时间戳
+        last_status: 上一次执行的状态, "success" 或 "error"
+        last_result: 上一次执行的返回值或异常的描述
+        run_count: 累计执行次数
+        finished: 一次性任务是否已经执行过
+    """
+    __slots__ = ("id", "timer", "next_run", "last_run", "last_status", "last_result", "run_count", "finished")
+
+    def __init__(
+            self,
+            id: str,
+            timer: str,
+            next_run: Optional[float] = None,
+            last_run: Optional[float] = None,
+            last_status: Optional[str] = None,
+            last_result: Optional[str] = None,
+            run_count: int = 0,
+            finished: bool = False,
+    ):
+        self.id = id
+        self.timer = timer
+        self.next_run = next_run
+        self.last_run = last_run
+        self.last_status = last_status
+        self.last_result = last_result
+        self.run_count = run_count
+        self.finished = finished
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "JobRecord":
+        return cls(**{k: data[k] for k in cls.__slots__ if k in data})
+
+    def __repr__(self):
+        return f"<JobRecord {self.id} next_run={self.next_run} run_count={self.run_count}>"
+
+
+class JobStore(abc.ABC):
+    """任务存储的基类"""
+
+    @abc.abstractmethod
+    def load_all(self) -> Dict[str, JobRecord]:
+        """读取全部记录"""
+
+    @abc.abstractmethod
+    def save_many(self, records: Iterable[JobRecord]) -> None:
+        """写入 (新增或覆盖) 多条记录"""
+
+    @abc.abstractmethod
+    def remove(self, job_id: str) -> None:
+        """删除一条记录"""
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteJobStore(JobStore):
+    """
+    以 SQLite 数据库保存任务记录
+
+    Args:
+        path: 数据库文件的路径
+        table: 使用的表名
+    """
+
+    def __init__(self, path: Union[str, Path] = "cesloi_jobs.db", table: str = "cesloi_jobs"):
+        self.path = str(path)
+        self.table = table
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)  # 由 Toconada 在线程池中写入
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "id TEXT PRIMARY KEY, timer TEXT, next_run REAL, last_run REAL, last_status TEXT, "
+            "last_result TEXT, run_count INTEGER, finished INTEGER)"
+        )
+        self.connection.commit()
+
+    def load_all(self) -> Dict[str, JobRecord]:
+        cursor = self.connection.execute(f"SELECT {', '.join(JobRecord.__slots__)} FROM {self.table}")
+        records = {}
+        for row in cursor:
+            record = JobRecord(*row)
+            record.finished = bool(record.finished)
+            records[record.id] = record
+        return records
+
+    def save_many(self, records: Iterable[JobRecord]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} ({', '.join(JobRecord.__slots__)}) "
+                f"VALUES ({', '.join('?' * len(JobRecord.__slots__))})",
+                [tuple(getattr(r, k) for k in JobRecord.__slots__) for r in records]
+            )
+
+    def remove(self, job_id: str) -> None:
+        with self.connection:
+            self.connection.execute(f"DELETE FROM {self.table} WHERE id = ?", (job_id,))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class JSONJobStore(JobStore):
+    """
+    以 JSON 文件保存任务记录; 每次写入都会重写整个文件, 通过临时文件替换保证写入的原子性
+
+    Args:
+        path: JSON 文件的路径
+    """
+
+    def __init__(self, path: Union[str, Path] = "cesloi_jobs.json"):
+        self.path = Path(path)
+        self.records: Dict[str, JobRecord] = {}
+
+    def load_all(self) -> Dict[str, JobRecord]:
+        if self.path.exists():
+            data = codec.loads(self.path.read_bytes())
+            self.records = {i["id"]: JobRecord.from_dict(i) for i in data}
+        return dict(self.records)
+
+    def _write(self):
+        temp = self.path.with_name(self.path.name + ".tmp")
+        temp.write_bytes(codec.dumps_bytes([i.to_dict() for i in self.records.values()]))
+        os.replace(temp, self.path)
+
+    def save_many(self, records: Iterable[JobRecord]) -> None:
+        for record in records:
+            self.records[record.id] = record
+        self._write()
+
+    def remove(self, job_id: str) -> None:
+        if self.records.pop(job_id, None):
+            self._write()
@@ -1,22 +1,51 @@
 import asyncio
+import random
+import time
 import traceback
 from datetime import datetime
-from typing import Callable
-from .timers import Timer
+from enum import Enum
+from typing import Callable, Optional, Iterator, Dict, Union
+from .timers import Timer, MisfirePolicy
+from ..executor import ExecutionMode, get_executor
 from .event import ScheduleTaskEvent
 from .schedule import EventSystem
 from ...letoderea import Subscriber
 from ...letoderea.handler import await_exec_target
 
+
+class OverlapPolicy(Enum):
+    """正在执行的实例数已达上限时, 新到达的执行的处理方式"""
+    skip = "skip"  # 丢弃本次执行
+    queue = "queue"  # 排队, 最多排队一次; 排队期间再到达的执行会被合并
+
+
 class TimingTask:
+    """
+    由 Toconada 调度的定时任务; 任务本身不持有 asyncio 任务, 只记录下一次执行的时间
+
+    同时执行的实例数受 max_instances 限制, 超出时按 overlap 丢弃或排队;
+    jitter 为每次执行附加的随机延迟, 只影响实际执行的时刻, 不影响之后的计划时间
+
+    Args:
+        callable_target: 要执行的函数/方法
+        timer: 时间器实例
+        event_system: 事件系统的实例
+        is_disposable: 是否只执行一次
+        job_id: 任务在任务存储中的标识, 默认为函数的 模块名.限定名
+        mode: 执行方式, 参考executor.ExecutionMode
+        overlap: 实例数已达上限时的处理方式
+        max_instances: 允许同时执行的实例数
+        jitter: 随机延迟的上限, 单位为秒
+    """
     callable_target: Callable
-    task: asyncio.Task
     timer: Timer
     event_system: EventSystem
     is_disposable: bool = False
     is_stop: bool = False
-    is_start: bool = False
-    interval_offset: float = 0
+    running: int = 0  # 正在执行的实例数
+    pending: bool = False
+    deadline: Optional[float] = None  # 下一次执行的 monotonic 时间
+    recheck: bool = False  # 为 True 时到达 deadline 只重新计算时间, 不执行
 
     def __init__(
             self,
@@ -24,58 +53,177 @@ class TimingTask:
             timer: Timer,
             event_system: EventSystem,
             is_disposable: bool = False,
+            job_id: Optional[str] = None,
+            mode: ExecutionMode = ExecutionMode.auto,
+            overlap: OverlapPolicy = OverlapPolicy.queue,
+            max_instances: int = 1,
+            jitter: float = 0.0,
     ) -> None:
         self.callable_target = callable_target
         self.timer = timer
         self.event_system = event_system
         self.is_disposable = is_disposable
+        self.subscriber = Subscriber.set()(get_executor().wrap(callable_target, mode))
+        self.delta_generator: Iterator[datetime] = timer.get_delta()
+        self.last_fire: Optional[datetime] = None
+        self.run_count: int = 0
+        self.finished: asyncio.Future = event_system.loop.create_future()
+        self.id = job_id or f"{callable_target.__module__}.{callable_target.__qualname__}"
+        self.last_run: Optional[float] = None  # 上一次执行开始的 unix 时间戳
+        self.last_status: Optional[str] = None
+        self.last_result: Optional[str] = None
+        self.listener: Optional[Callable[["TimingTask"], None]] = None  # 每次执行结束后调用
+        self.misfire: MisfirePolicy = timer.misfire or MisfirePolicy.run_once  # 加入调度器时按其设置确定
+        self.overlap = overlap
+        self.max_instances = max(max_instances, 1)
+        self.jitter = jitter
+        self.skipped: int = 0
+        self.coalesced: int = 0
+        self.failures: int = 0
+        self.completed: int = 0
+        self.last_duration: float = 0.0
+        self.max_duration: float = 0.0
+        self.total_duration: float = 0.0
 
-    def set_task(self):
-        if not self.is_start:
-            self.task = self.event_system.loop.create_task(self.run_task())
-        else:
-            raise RuntimeError("the scheduler task has been started!")
+    @property
+    def is_running(self) -> bool:
+        return self.running > 0
 
-    def interval_generator(self):
-        for next_execute_time in self.timer.get_delta():
-            if self.is_stop:
-                return
-            now = datetime.now()
-            if next_execute_time >= now:
-                yield (next_execute_time - now).total_seconds() - self.interval_offset
-
-    def coroutine_generator(self):
-        for sleep_interval in self.interval_generator():
-            yield asyncio.sleep(sleep_interval), True
-            yield await_exec_target(
-                Subscriber.set()(self.callable_target), ScheduleTaskEvent.get_params
-            ), False
+    @property
+    def signature(self) -> str:
+        """时间器的描述, 用于判断持久化的记录是否仍然适用"""
+        timer_type = getattr(self.timer, "type", type(self.timer).__name__)
+        return f"{timer_type}:{sorted(self.timer.interval.items())}"
+
+    def next_deadline(self, now: float) -> Optional[float]:
+        """
+        计算下一次执行的 monotonic 时间, 返回 None 表示不再执行
+
+        固定间隔的时间器在上一次的计划时间上累加间隔, 执行耗时与调度延迟不会累积为漂移;
+        带有 next_fire 的时间器 (CronTimer, RouteTimer 与 SpecialTimer) 从上一次的计划时间推算下一次,
+        并按任务的 misfire 处理错过的执行 (时间器未指定时使用调度器的 misfire); 其他时间器按墙上时间计算,
+        已经过去的时刻会被跳过
+        """
+        self.recheck = False
+        if self.is_stop:
+            return None
+        period = self.timer.period
+        if period:
+            if self.deadline is None:
+                return now + period
+            deadline = self.deadline + period
+            if deadline < now:  # 错过的执行不补
+                deadline += (now - deadline) // period * period + period
+            return deadline
+        if hasattr(self.timer, "next_fire"):
+            return self._next_fire_deadline(now)
+        # 跳过已经过去或已经执行过的时刻; 时间器长时间给不出新的时刻时, 一秒后重新计算
+        current = time.time()
+        for pulled, next_time in enumerate(self.delta_generator, 1):
+            timestamp = next_time.timestamp()
+            if timestamp >= current and (self.last_fire is None or timestamp > self.last_fire.timestamp()):
+                self.last_fire = next_time
+                return now + timestamp - current
+            if pulled >= 1024:
+                self.recheck = True
+                return now + 1.0
+        return None
+
+    def _next_fire_deadline(self, now: float) -> Optional[float]:
+        timer = self.timer
+        wall = timer.now()
+        next_time = timer.next_fire(self.last_fire or wall)
+        if next_time is None:
+            return None
+        delay = next_time.timestamp() - time.time()
+        if delay < -timer.misfire_grace:
+            if self.misfire is MisfirePolicy.skip:
+                next_time = timer.next_fire(wall)
+                if next_time is None:
+                    return None
+                delay = next_time.timestamp() - time.time()
+            elif self.misfire is MisfirePolicy.run_once:
+                next_time = wall  # 补执行一次, 之后从当前时间继续推算
+        self.last_fire = next_time
+        return now + max(delay, 0.0)
+
+    def jitter_delay(self) -> float:
+        """本次执行附加的随机延迟"""
+        return random.uniform(0, self.jitter) if self.jitter > 0 else 0.0
+
+    def fire(self):
+        """到达执行时间; 实例数已达上限时按 overlap 处理"""
+        if self.running >= self.max_instances:
+            if self.overlap is OverlapPolicy.skip:
+                self.skipped += 1
+            elif self.pending:
+                self.coalesced += 1
+            else:
+                self.pending = True
+            return
+        self.running += 1
+        self.event_system.loop.create_task(self.run_task())
 
     async def run_task(self) -> None:
-        for coro, waiting in self.coroutine_generator():
-            if waiting:  # 是否为 asyncio.sleep 的 coro
-                try:
-                    await coro
-                except asyncio.CancelledError:
-                    return
-            else:  # 执行
-                try:
-                    await coro
-                except Exception as e:
-                    traceback.print_exc()
-                else:
-                    now = datetime.now()
-                    self.interval_offset = (now.microsecond / 1000000)
-                    if self.is_disposable:
-                        self.is_stop = True
+        try:
+            while True:
+                self.pending = False
+                await self._execute()
+                if not self.pending or self.is_stop:
+                    break
+        finally:
+            self.running -= 1
+            if self.is_stop:
+                self.pending = False
+            self.check_finished()
+
+    async def _execute(self):
+        self.run_count += 1
+        self.last_run = time.time()
+        start = time.perf_counter()
+        try:
+            result = await await_exec_target(self.subscriber, ScheduleTaskEvent.get_params)
+        except Exception as e:
+            traceback.print_exc()
+            self.failures += 1
+            self.last_status, self.last_result = "error", f"{type(e).__name__}: {e}"
+        else:
+            self.last_status, self.last_result = "success", None if result is None else repr(result)[:256]
+        duration = time.perf_counter() - start
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        self.completed += 1
+        if self.listener:
+            self.listener(self)
+
+    def metrics(self) -> Dict[str, Union[int, float, None]]:
+        """返回执行次数、丢弃与合并的次数以及执行耗时(单位为秒)等统计信息"""
+        return {
+            "running": self.running,
+            "pending": self.pending,
+            "run_count": self.run_count,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "coalesced": self.coalesced,
+            "last_duration": self.last_duration,
+            "max_duration": self.max_duration,
+            "avg_duration": self.total_duration / self.completed if self.completed else 0.0,
+            "next_run": None if self.deadline is None else self.deadline - time.monotonic(),
+        }
+
+    def check_finished(self):
+        if (self.is_stop or self.is_disposable and self.deadline is None) and not self.is_running:
+            if not self.finished.done():
+                self.finished.set_result(None)
 
     async def join(self, stop=False):
         if stop and not self.is_stop:
-            self.is_stop = True
-
-        if self.task:
-            await self.task
+            self.stop()
+        await asyncio.shield(self.finished)
 
     def stop(self):
-        if not self.task.cancelled():
-            self.task.cancel()
+        """停止任务; 调度器中的记录会在到期时被丢弃"""
+        self.is_stop = True
+        self.deadline = None
+        self.check_finished()
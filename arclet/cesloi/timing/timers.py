@@ -1,16 +1,40 @@
-from datetime import datetime, timedelta
-from typing import Dict, Union
+from datetime import datetime, timedelta, tzinfo
+from enum import Enum
+from typing import Dict, Union, Optional
 import abc
 
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+
+class MisfirePolicy(Enum):
+    """错过执行时间 (例如事件循环被阻塞或程序重启) 时的处理方式"""
+    skip = "skip"  # 跳过错过的执行, 等待下一次
+    run_once = "run_once"  # 立即补执行一次
+    run_all = "run_all"  # 逐次补执行全部错过的执行
+
 
 class Timer(abc.ABC):
     type: str
     interval: Dict[str, Union[int, float]] = {}
+    tz: Optional[tzinfo] = None
+    misfire: Optional[MisfirePolicy] = None  # None 时使用调度器的 misfire
+    misfire_grace: float = 1.0
+
+    def now(self) -> datetime:
+        return datetime.now(self.tz)
 
     @abc.abstractmethod
     def get_delta(self):
         pass
 
+    @property
+    def period(self) -> Optional[float]:
+        """固定的执行间隔, 单位为秒; 不是固定间隔的时间器返回 None"""
+        return None
+
 
 class EveryTimer(Timer):
     """
@@ -28,6 +52,10 @@ class EveryTimer(Timer):
         while True:
             yield datetime.now() + timedelta(**self.interval)
 
+    @property
+    def period(self) -> float:
+        return timedelta(**self.interval).total_seconds()
+
     def every_second(self):
         """每秒执行一次
         """
@@ -55,7 +83,7 @@ class EveryTimer(Timer):
         Args:
             minutes (int): 距离下一次执行的时间间隔, 单位为分
         """
-        self.interval = {"seconds": minutes}
+        self.interval = {"minutes": minutes}
         return self
 
     def every_hour(self):
@@ -109,14 +137,43 @@ class RouteTimer(Timer):
     从对应的0时刻开始计时
     """
     type: str = 'route'
+    _cron: Optional[tuple] = None  # (interval, 对应的 CronTimer)
 
     def get_delta(self):
+        next_time = self.now()
         while True:
-            yield self._start_time()
+            next_time = self.next_fire(next_time)
+            yield next_time
+
+    def to_cron(self) -> "CronTimer":
+        """
+        转换为等价的 CronTimer: 指定的单位取指定的值, 比最大的指定单位更小的其他单位取 0, 更大的单位不限
+        """
+        key = tuple(sorted(self.interval.items()))
+        if self._cron is None or self._cron[0] != key:
+            units = [("seconds", 60), ("minutes", 60), ("hours", 24), ("days", None)]
+            largest = max((i for i, (name, _) in enumerate(units) if name in self.interval), default=-1)
+            if "weeks" in self.interval or "days" in self.interval:
+                largest = max(largest, 3)
+            fields = []
+            for i, (name, modulo) in enumerate(units):
+                if name in self.interval:
+                    value = int(self.interval[name])
+                    fields.append(str(value % modulo if modulo else value))
+                else:
+                    fields.append("0" if i < largest else "*")
+            weekday = "*"
+            if "weeks" in self.interval:
+                weekday = str(round(self.interval["weeks"] * 7) % 7)  # monday = 1, 0 与 7 为星期日
+            self._cron = (key, CronTimer(" ".join(fields + ["*", weekday])))
+        return self._cron[1]
+
+    def next_fire(self, after: datetime) -> Optional[datetime]:
+        """晚于 after 的下一次执行时间"""
+        return self.to_cron().next_fire(after)
 
     def __init__(self, **kwargs):
-        if kwargs:
-            self.interval = kwargs
+        self.interval = dict(kwargs)  # route_* 会修改 interval, 不能共用类属性
 
     def route_second(self, seconds: int):
         """在每分钟的第 seconds 秒执行一次
@@ -174,59 +231,33 @@ class RouteTimer(Timer):
         return self
 
     def _start_time(self):
-        now = datetime.now()
-        year = now.year
-        month = now.month
-        weekday = now.weekday()
-        day = now.day
-        hour = now.hour
-        minute = now.minute
-        second = now.second
-        for k, v in self.interval.items():
-            if k == 'hours':
-                if v - hour < 0:
-                    day += 1
-                hour = v
-                minute = 0
-                second = 0
-
-            elif k == 'minutes':
-                if v - minute < 0:
-                    hour += 1
-                minute = v
-                second = 0
-            elif k == 'seconds':
-                if v - second < 0:
-                    minute += 1
-                second = v
-            elif k == 'weeks':
-                hour = 0
-                minute = 0
-                second = 0
-                day += 6 - weekday
-
-            if k == 'days':
-                if v - day < 0:
-                    month += 1
-                day = v
-                hour = 0
-                minute = 0
-                second = 0
-        return datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second)
+        return self.next_fire(self.now())
 
 
 class SpecialTimer(Timer):
     """
     直到一年中一个特定的时间才执行
     """
+    type: str = 'special'
 
     def __init__(self, **kwargs):
         if kwargs:
             self.interval = kwargs
 
     def get_delta(self):
+        next_time = self.now()
         while True:
-            yield self._start_time()
+            next_time = self.next_fire(next_time)
+            if next_time is None:
+                return
+            yield next_time
+
+    def next_fire(self, after: datetime) -> Optional[datetime]:
+        """晚于 after 的下一次执行时间"""
+        i = self.interval
+        return CronTimer(
+            f"{i.get('second', 0)} {i.get('minute', 0)} {i.get('hour', 0)} {i['day']} {i['month']} *"
+        ).next_fire(after)
 
     def set_special_day(
             self,
@@ -240,11 +271,152 @@ class SpecialTimer(Timer):
         return self
 
     def _start_time(self):
-        now = datetime.now()
-        year = now.year
-        if self.interval['month'] < now.month:
-            year += 1
-        return datetime(year=year, **self.interval)
+        return self.next_fire(self.now())
+
+
+_cron_aliases = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+_cron_names = {
+    name: i for names in (
+        ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"),
+    ) for i, name in enumerate(names, 1)
+}
+_cron_names.update((name, i) for i, name in enumerate(("sun", "mon", "tue", "wed", "thu", "fri", "sat")))
+_cron_ranges = ((0, 59), (0, 59), (0, 23), (1, 31), (1, 12), (0, 7))  # 秒 分 时 日 月 星期
+
+
+def _parse_cron_field(text: str, low: int, high: int) -> int:
+    """将 cron 表达式的一个字段解析为位集, 第 n 位为 1 表示值 n 匹配"""
+    mask = 0
+    for part in text.lower().split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError(f"invalid cron step: {text}")
+        if part in ("*", "?"):
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(_cron_names.get(i, i)) for i in part.split("-", 1))
+        else:
+            start = int(_cron_names.get(part, part))
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"invalid cron field: {text}")
+        for value in range(start, end + 1, step):
+            mask |= 1 << value
+    return mask
+
+
+def _next_bit(mask: int, start: int) -> Optional[int]:
+    """位集中不小于 start 的最小值"""
+    mask >>= start
+    if not mask:
+        return None
+    return start + (mask & -mask).bit_length() - 1
+
+
+class CronTimer(Timer):
+    """
+    按 cron 表达式执行; 表达式在创建时解析为位集, 之后每次计算下一次执行时间只需少量位运算
+
+    支持 5 段 (分 时 日 月 星期) 或 6 段 (秒 分 时 日 月 星期) 的表达式, 以及 @daily 等别名;
+    日与星期同时被限定时, 满足其一即可, 与通常的 cron 一致
+
+    Args:
+        expression: cron 表达式
+        tz: 时区, 可以是时区名称或 tzinfo; 不填时使用本地时间
+        misfire: 错过执行时间时的处理方式
+        misfire_grace: 超过计划时间多少秒才视为错过
+    """
+    type: str = 'cron'
+
+    def __init__(
+            self,
+            expression: str,
+            tz: Optional[Union[str, tzinfo]] = None,
+            misfire: MisfirePolicy = MisfirePolicy.run_once,
+            misfire_grace: float = 1.0,
+    ):
+        fields = _cron_aliases.get(expression.strip(), expression).split()
+        if len(fields) == 5:
+            fields.insert(0, "0")
+        if len(fields) != 6:
+            raise ValueError(f"invalid cron expression: {expression}")
+        self.expression = expression
+        self.seconds, self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            _parse_cron_field(field, *bounds) for field, bounds in zip(fields, _cron_ranges)
+        )
+        if self.weekdays & (1 << 7):  # 7 与 0 都表示星期日
+            self.weekdays = (self.weekdays | 1) & ~(1 << 7)
+        self.days_restricted = fields[3] not in ("*", "?")
+        self.weekdays_restricted = fields[5] not in ("*", "?")
+        if isinstance(tz, str):
+            if ZoneInfo is None:
+                raise ImportError("zoneinfo is required for time zone names, please pass a tzinfo instead")
+            tz = ZoneInfo(tz)
+        self.tz = tz
+        self.misfire = misfire
+        self.misfire_grace = misfire_grace
+        self.interval = {"cron": expression}
+
+    def _day_matches(self, t: datetime) -> bool:
+        day = self.days >> t.day & 1
+        weekday = self.weekdays >> ((t.weekday() + 1) % 7) & 1
+        if self.days_restricted and self.weekdays_restricted:
+            return bool(day or weekday)
+        return bool(day and weekday)
+
+    def next_fire(self, after: datetime) -> Optional[datetime]:
+        """晚于 after 的下一次执行时间; 表达式不可能满足时返回 None"""
+        if self.tz is not None:
+            after = after.astimezone(self.tz) if after.tzinfo else after.replace(tzinfo=self.tz)
+        t = after.replace(microsecond=0) + timedelta(seconds=1)
+        year_limit = t.year + 8  # 足够覆盖 2 月 29 日这样的表达式
+        while t.year <= year_limit:
+            month = _next_bit(self.months, t.month)
+            if month is None:
+                t = t.replace(year=t.year + 1, month=1, day=1, hour=0, minute=0, second=0)
+                continue
+            if month != t.month:
+                t = t.replace(month=month, day=1, hour=0, minute=0, second=0)
+            if not self._day_matches(t):
+                t = t.replace(hour=0, minute=0, second=0) + timedelta(days=1)
+                continue
+            hour = _next_bit(self.hours, t.hour)
+            if hour is None:
+                t = t.replace(hour=0, minute=0, second=0) + timedelta(days=1)
+                continue
+            if hour != t.hour:
+                t = t.replace(hour=hour, minute=0, second=0)
+            minute = _next_bit(self.minutes, t.minute)
+            if minute is None:
+                t = t.replace(minute=0, second=0) + timedelta(hours=1)
+                continue
+            if minute != t.minute:
+                t = t.replace(minute=minute, second=0)
+            second = _next_bit(self.seconds, t.second)
+            if second is None:
+                t = t.replace(second=0) + timedelta(minutes=1)
+                continue
+            return t.replace(second=second)
+        return None
+
+    def get_delta(self):
+        next_time = self.now()
+        while True:
+            next_time = self.next_fire(next_time)
+            if next_time is None:
+                return
+            yield next_time
 
 
 if __name__ == "__main__":
@@ -265,3 +437,8 @@ if __name__ == "__main__":
 
     c = SpecialTimer().set_special_day(12, 1, 12)
     print(c._start_time() - datetime.now())
+
+    import timeit
+    cron = CronTimer("*/5 9-18 * * mon-fri", tz="Asia/Shanghai")
+    print(list(zip(range(3), cron.get_delta())))
+    print(f"next_fire: {timeit.timeit(lambda: cron.next_fire(cron.now()), number=10000) / 10000 * 1e6:.2f}us")
@@ -2,12 +2,16 @@ import functools
 from contextvars import ContextVar
 from contextlib import contextmanager
 from enum import Enum
-from typing import Callable, Any, Union, TYPE_CHECKING, Dict, Type
+from typing import Callable, Any, Union, TYPE_CHECKING, Dict, Type, List, Tuple, Optional
 
+import aiohttp
 from pydantic.main import BaseModel, BaseConfig, Extra
+from pydantic.error_wrappers import ValidationError
+from pydantic.fields import ModelField, SHAPE_SINGLETON, SHAPE_LIST
 
 if TYPE_CHECKING:
     from pydantic.typing import AbstractSetIntStr, DictStrAny, MappingIntStrAny
+    from .model.cache import IdentityMap
 
 bot_application = ContextVar("bot_application")
 event = ContextVar("event")
@@ -77,11 +81,183 @@ class ContextCollection:
     upload_method: ContextModel
 
 
+class HttpPoolConfig:
+    """
+    应用的所有出站 HTTP 请求共用的连接池的配置
+
+    Args:
+        limit: 连接总数上限, 0 为不限
+        limit_per_host: 单个主机的连接数上限, 0 为不限
+        keepalive_timeout: 空闲连接的保活时间, 单位为秒
+        dns_cache_ttl: DNS 解析结果的缓存时间, 单位为秒, None 为永久缓存
+        connect_timeout: 建立连接的超时时间, 单位为秒
+        read_timeout: 单次读取的超时时间, 单位为秒, None 为不限
+        total_timeout: 单个请求 (含读取响应) 的总超时时间, 单位为秒, 与 aiohttp 的默认值相同; None 为不限,
+            此时停滞的上游 (如多媒体下载) 会使请求一直挂起
+    """
+
+    def __init__(
+            self,
+            limit: int = 100,
+            limit_per_host: int = 32,
+            keepalive_timeout: float = 30.0,
+            dns_cache_ttl: Optional[int] = 300,
+            connect_timeout: Optional[float] = 10.0,
+            read_timeout: Optional[float] = None,
+            total_timeout: Optional[float] = 300.0,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+
+    def create_session(self) -> aiohttp.ClientSession:
+        """按配置创建连接池, 需要在事件循环中调用"""
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.total_timeout, sock_connect=self.connect_timeout, sock_read=self.read_timeout
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def http_request(method: str, url: str, **kwargs):
+    """
+    通过当前应用的连接池发起请求, 用法同 aiohttp.request;
+    不在应用上下文中时退回到一次性的 aiohttp.request
+    """
+    bot = bot_application.get(None)
+    if bot is not None:
+        return bot.get_http_session().request(method, url, **kwargs)
+    return aiohttp.request(method, url, **kwargs)
+
+
+class DecodeOptions:
+    """
+    入站数据的解析选项, 由各个 Communicator 分别持有, 互不影响
+
+    Args:
+        trusted_upstream: 为 True 时, 事件与消息链将跳过 pydantic 的校验直接构造, 仅适用于可信的上游
+        identity_map: 不为 None 时, 事件中的群、群成员与好友会复用其中的规范实例; 这些实例在事件之间共享,
+            并会被之后的数据原地更新, 默认不启用
+    """
+
+    def __init__(self, trusted_upstream: bool = False, identity_map: Optional["IdentityMap"] = None):
+        self.trusted_upstream = trusted_upstream
+        self.identity_map = identity_map
+
+
+_default_decode_options = DecodeOptions()
+
+
+def decode_model(model: Type[BaseModel], data: Any, options: Optional[DecodeOptions] = None) -> BaseModel:
+    """
+    按解析选项将入站数据解析为模型
+
+    Args:
+        model: 目标模型
+        data: 入站数据
+        options: 解析选项, 不填时进行完整校验
+    """
+    options = options or _default_decode_options
+    if options.identity_map is not None:
+        return options.identity_map.decode(model, data, options.trusted_upstream)
+    if options.trusted_upstream:
+        return construct_model(model, data)
+    return model.parse_obj(data)
+
+
+_PlanItem = Tuple[str, str, str, Any, ModelField]
+_construct_plans: Dict[Type[BaseModel], List[_PlanItem]] = {}
+_raw_types = (int, str, float, bool, Any)
+
+
+def _field_kind(field: ModelField) -> str:
+    type_ = field.type_
+    if field.sub_fields and field.shape == SHAPE_SINGLETON:  # Union 等需要判别的类型
+        return "validate"
+    if field.shape not in (SHAPE_SINGLETON, SHAPE_LIST):
+        return "validate"
+    if type_ in _raw_types:
+        return "raw"
+    if not isinstance(type_, type):
+        return "validate"
+    if issubclass(type_, BaseModel):
+        if type_.__custom_root_type__:
+            return "root" if field.shape == SHAPE_SINGLETON else "validate"
+        return "model" if field.shape == SHAPE_SINGLETON else "model_list"
+    if issubclass(type_, Enum) and field.shape == SHAPE_SINGLETON:
+        return "enum"
+    return "validate"
+
+
+def _construct_plan(model: Type[BaseModel]) -> List[_PlanItem]:
+    plan = _construct_plans.get(model)
+    if plan is None:
+        plan = [
+            (field.name, field.alias, _field_kind(field), field.type_, field)
+            for field in model.__fields__.values()
+        ]
+        _construct_plans[model] = plan
+    return plan
+
+
+def construct_model(model: Type[BaseModel], data: Any) -> BaseModel:
+    """不经校验地从 dict 构造模型, 嵌套的模型、枚举与消息链会被递归构造
+
+    缺少必填字段时回退到 parse_obj, 以便给出正常的校验错误
+    """
+    if not isinstance(data, dict):
+        return model.parse_obj(data)
+    values = {}
+    for name, alias, kind, type_, field in _construct_plan(model):
+        if alias not in data:
+            if field.required:
+                return model.parse_obj(data)
+            continue
+        value = data[alias]
+        if value is None or kind == "raw":
+            values[name] = value
+        elif kind == "model":
+            values[name] = value if isinstance(value, type_) else construct_model(type_, value)
+        elif kind == "model_list":
+            values[name] = [v if isinstance(v, type_) else construct_model(type_, v) for v in value]
+        elif kind == "enum":
+            values[name] = value if isinstance(value, type_) else type_(value)
+        elif kind == "root":
+            if isinstance(value, type_):
+                values[name] = value
+            else:
+                values[name] = type_.parse_trusted(value) if issubclass(type_, Structured) else type_.parse_obj(value)
+        else:
+            value, errors = field.validate(value, values, loc=alias, cls=model)
+            if errors:
+                raise ValidationError([errors], model)
+            values[name] = value
+    if model.__config__.extra is Extra.allow and len(data) > len(values):
+        aliases = {item[1] for item in _construct_plan(model)}
+        values.update((k, v) for k, v in data.items() if k not in aliases)
+    return model.construct(set(values), **values)
+
+
 class Structured(BaseModel):
     """
     一切数据模型的基类.
     """
 
+    @classmethod
+    def parse_trusted(cls, obj: Any):
+        """跳过校验, 从可信的上游数据构造模型"""
+        return construct_model(cls, obj)
+
     def dict(
             self,
             *,
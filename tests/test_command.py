@@ -0,0 +1,36 @@
+from arclet.cesloi.message.command import Command
+
+
+def test_named_group_falls_back_to_separate_patterns():
+    command = Command(main=["(?P<x>\\d+)", [["-a"], ["-b"]]])
+    assert command.analysis("12 -a") == "12"
+    assert command.analysis("12 -c") is False
+
+
+def test_backreference_keeps_its_meaning():
+    command = Command(main=["(a)\\1 go"])
+    assert command.analysis("aa go") == "a"
+    assert command.analysis("ab go") is False
+
+
+def test_router_indexes_top_level_alternation_without_prefix():
+    from arclet.cesloi.message.command import CommandRouter
+
+    command = Command(main=["a|b go"])
+    router = CommandRouter()
+    router.register(command, lambda result: result)
+    for text in ("a", "b go"):
+        routed = router.route(text)
+        assert routed is not None
+        assert routed[1] == command.analysis(text) is True
+    assert router.route("c go") is None
+
+
+def test_router_keeps_literal_prefix_of_alternatives_in_groups():
+    from arclet.cesloi.message.command import CommandRouter, _command_prefix
+
+    command = Command(main=["go (a|b)"])
+    assert _command_prefix(command) == "go "
+    router = CommandRouter()
+    router.register(command, lambda result: result)
+    assert router.route("go b")[1] == "b"
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+
+from arclet.letoderea import EventSystem
+from arclet.cesloi.timing.schedule import Toconada
+from arclet.cesloi.timing.store import SQLiteJobStore, JSONJobStore
+from arclet.cesloi.timing.timers import SpecialTimer, EveryTimer, CronTimer, MisfirePolicy
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def open_store(request, tmp_path):
+    """每次调用打开同一份存储的新实例, 用于模拟重启"""
+    opened = []
+
+    def factory():
+        if request.param == "sqlite":
+            store = SQLiteJobStore(tmp_path / "jobs.db")
+        else:
+            store = JSONJobStore(tmp_path / "jobs.json")
+        opened.append(store)
+        return store
+
+    yield factory
+    for store in opened:
+        store.close()
+
+
+async def _run_job(store, timer, runs, duration=0.3, **kwargs):
+    """加入一个任务, 运行 duration 秒后停止调度; 返回停止前任务距下一次执行的秒数"""
+    scheduler = Toconada(EventSystem(loop=asyncio.get_running_loop()), store=store)
+
+    @scheduler.timing(timer, job_id="job", max_instances=16, **kwargs)
+    async def job():
+        runs.append(time.time())
+
+    task = scheduler.schedule_tasks[0]
+    remaining = None if task.deadline is None else task.deadline - time.monotonic()
+    await asyncio.sleep(duration)
+    await scheduler.stop()
+    return remaining
+
+
+async def _schedule_special(store):
+    scheduler = Toconada(EventSystem(loop=asyncio.get_running_loop()), store=store)
+
+    @scheduler.timing(SpecialTimer().set_special_day(12, 1, 12), job_id="special")
+    async def job():
+        pass
+
+    await scheduler.stop()
+    return scheduler
+
+
+def test_special_timer_job_is_stored(tmp_path):
+    for store in (SQLiteJobStore(tmp_path / "jobs.db"), JSONJobStore(tmp_path / "jobs.json")):
+        scheduler = asyncio.run(_schedule_special(store))
+        records = store.load_all()
+        assert records["special"].timer == scheduler.schedule_tasks[0].signature
+        assert records["special"].timer.startswith("special:")
+        assert records["special"].next_run is not None
+        store.close()
+
+
+def test_next_run_is_restored(open_store):
+    store = open_store()
+    asyncio.run(_run_job(store, EveryTimer(hours=1), [], duration=0))
+    next_run = store.load_all()["job"].next_run
+    assert next_run == pytest.approx(time.time() + 3600, abs=5)
+    store.close()
+
+    runs = []
+    remaining = asyncio.run(_run_job(open_store(), EveryTimer(hours=1), runs, duration=0))
+    assert remaining == pytest.approx(next_run - time.time(), abs=1)
+    assert not runs
+
+
+@pytest.mark.parametrize("policy, expected", [
+    (MisfirePolicy.skip, 0), (MisfirePolicy.run_once, 1), (MisfirePolicy.run_all, 3)
+])
+def test_missed_fire_follows_misfire_policy(open_store, policy, expected):
+    store = open_store()
+    asyncio.run(_run_job(store, CronTimer("0 * * * *", misfire=policy), [], duration=0))
+    # 模拟停机三小时: 记录中的下一次执行时间是三个整点之前
+    record = store.load_all()["job"]
+    hour = datetime.now().replace(minute=0, second=0, microsecond=0).timestamp()
+    record.next_run = hour - 3 * 3600
+    store.save_many([record])
+    store.close()
+
+    runs = []
+    store = open_store()
+    asyncio.run(_run_job(store, CronTimer("0 * * * *", misfire=policy), runs))
+    if policy is MisfirePolicy.run_all:
+        assert len(runs) >= expected  # 当前整点已过去超过宽限时间时也会补执行
+    else:
+        assert len(runs) == expected
+    assert store.load_all()["job"].next_run > time.time()
+
+
+def test_finished_disposable_job_does_not_run_again(open_store):
+    store = open_store()
+    runs = []
+    asyncio.run(_run_job(store, EveryTimer(seconds=0.05), runs, is_disposable=True))
+    assert len(runs) == 1
+    assert store.load_all()["job"].finished
+    store.close()
+
+    runs = []
+    asyncio.run(_run_job(open_store(), EveryTimer(seconds=0.05), runs, is_disposable=True))
+    assert not runs
+
+
+def test_cancelled_job_record_is_removed(open_store):
+    async def cancel(store):
+        scheduler = Toconada(EventSystem(loop=asyncio.get_running_loop()), store=store)
+        scheduler.timing(EveryTimer(hours=1), job_id="job")(lambda: None)
+        scheduler.timing(EveryTimer(hours=1), job_id="other")(lambda: None)
+        await scheduler.flush()
+        scheduler.cancel(scheduler.schedule_tasks[0])
+        await scheduler.stop()
+
+    store = open_store()
+    asyncio.run(cancel(store))
+    store.close()
+    assert set(open_store().load_all()) == {"other"}